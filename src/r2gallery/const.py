@@ -7,17 +7,23 @@ Templates         = "templates"
 Output_Local      = "output_local"
 Output_Web        = "output_web"
 Output_R2         = "output_r2"
-Not_Album_Folders = [Output_Local, Output_Web, Output_R2, Templates]
+Jinja_Cache       = "jinja_cache"
+Not_Album_Folders = [Output_Local, Output_Web, Output_R2, Templates, Jinja_Cache]
 
 Gallery_Toml     = "gallery.toml"
 Album_Toml       = "album.toml"
 Picture_Toml     = "picture.toml"
 Metadata         = "metadata"
 Thumbs           = "thumbs"
+Derivs           = "derivs"
 Use_Proxy        = "use_proxy"
 Http_Proxy       = "http_proxy"
 R2_Files_JSON    = "r2_files.json"
 R2_Waiting_JSON  = "r2_waiting.json"
+R2_Multipart_JSON = "r2_multipart.json"
+R2_Journal       = "r2_journal.jsonl"
+R2_Deleting_JSON = "r2_deleting.json"
+Cache_DB         = "r2g_cache.db"
 
 Pic_HTML              = "pic.html"
 Index_HTML            = "index.html"
@@ -29,7 +35,7 @@ Pics_Id_List_JS       = "pics_id_list.js"
 Dot_HTML = ".html"
 Dot_Toml = ".toml"
 Dot_JPEG = ".jpeg"
-# Dot_Webp = ".webp"
+Dot_WebP = ".webp"
 
 DateTimeOriginal = 36867
 DateTime         = 306
@@ -49,4 +55,12 @@ Output_Web_Path      = CWD.joinpath(Output_Web)
 Output_R2_Path       = CWD.joinpath(Output_R2)
 Gallery_Toml_Path    = CWD.joinpath(Gallery_Toml)
 R2_Waiting_JSON_Path = CWD.joinpath(R2_Waiting_JSON)
+R2_Multipart_JSON_Path = CWD.joinpath(R2_Multipart_JSON)
+R2_Journal_Path      = CWD.joinpath(R2_Journal)
+R2_Deleting_JSON_Path = CWD.joinpath(R2_Deleting_JSON)
 R2_Files_JSON_Path   = CWD.joinpath(R2_Files_JSON)
+Cache_DB_Path        = CWD.joinpath(Cache_DB)
+Jinja_Cache_Path     = CWD.joinpath(Jinja_Cache)
+
+Output_Paths = dict(r2=Output_R2_Path, local=Output_Local_Path, web=Output_Web_Path)
+"""输出目标 (target) 及其输出文件夹, 可用 `r2g --targets` 只生成其中一部分."""
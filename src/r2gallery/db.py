@@ -0,0 +1,223 @@
+import sqlite3
+import threading
+
+from .const import Cache_DB_Path
+from .model import ImageInfo
+
+"""
+本地缓存数据库 (SQLite), 保存在图库根目录 (与 gallery.toml 同一文件夹).
+
+images 表记录每张图片的体积, 修改时间, checksum, 尺寸, 拍摄日期等信息,
+执行 `r2g -update` 时, 体积与修改时间都没变的图片不需要再打开.
+删除该数据库文件不影响图库, 只是下次 update 需要重新读取全部图片.
+"""
+
+Create_Tables = """
+CREATE TABLE IF NOT EXISTS images (
+    album         TEXT NOT NULL,
+    name          TEXT NOT NULL,
+    filesize      INTEGER NOT NULL,
+    mtime_ns      INTEGER NOT NULL,
+    checksum      TEXT NOT NULL,
+    width         INTEGER NOT NULL,
+    height        INTEGER NOT NULL,
+    format        TEXT NOT NULL,
+    orientation   INTEGER NOT NULL,
+    datetime      TEXT NOT NULL,
+    thumb         TEXT NOT NULL DEFAULT '',
+    derivs        TEXT NOT NULL DEFAULT '',
+    toml_mtime_ns INTEGER NOT NULL DEFAULT 0,
+    ctime         TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (album, name)
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    key  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS markdown (
+    checksum TEXT PRIMARY KEY,
+    html     TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file_checksums (
+    path     TEXT PRIMARY KEY,
+    filesize INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode    INTEGER NOT NULL,
+    md5      TEXT NOT NULL
+);
+"""
+"""
+images.format 为空字符串表示不是图片;
+images.thumb 是生成缩略图时图片的 checksum, 空字符串表示未记录;
+images.derivs 是生成缩小版本时的 Gallery.deriv_signature;
+images.toml_mtime_ns 与 images.ctime 缓存图片 toml 里的 ctime, 用于排序.
+
+outputs 表 (build manifest) 记录每个输出文件 (相对于图库根目录的路径)
+的全部输入的 checksum (详见 util.build_key).
+
+markdown 表缓存 story 转换后的 HTML, 以 story 的 checksum 为 key
+(详见 model.MarkdownCache).
+
+file_checksums 表缓存 output_r2 里的文件的 MD5 (详见 r2.FileChecksumCache),
+path 是相对于图库根目录的路径.
+"""
+
+Schema_Version = 4
+"""修改表结构时加一, 旧版本的缓存会被清空重建."""
+
+Image_Info_Columns = [
+    "filesize", "mtime_ns", "checksum", "width", "height",
+    "format", "orientation", "datetime",
+]
+
+_conn: sqlite3.Connection | None = None
+
+_lock = threading.Lock()
+"""渲染网页时会在多个线程中更新 outputs 表"""
+
+
+def get_conn() -> sqlite3.Connection:
+    """第一次使用时才打开 (或新建) 数据库."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(Cache_DB_Path, check_same_thread=False)
+        _conn.row_factory = sqlite3.Row
+        version = _conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != Schema_Version:
+            drop_all_tables(_conn)
+            _conn.execute(f"PRAGMA user_version={Schema_Version}")
+        _conn.executescript(Create_Tables)
+    return _conn
+
+
+def drop_all_tables(conn:sqlite3.Connection):
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    for name in [row[0] for row in rows]:
+        conn.execute(f"DROP TABLE {name}")
+
+
+_output_keys: dict[str, str] | None = None
+
+
+def load_output_keys() -> dict[str, str]:
+    """读取整个 outputs 表 (只读取一次)"""
+    global _output_keys
+    with _lock:
+        if _output_keys is None:
+            rows = get_conn().execute("SELECT path, key FROM outputs")
+            _output_keys = {row["path"]: row["key"] for row in rows}
+    return _output_keys
+
+
+def get_output_key(path:str) -> str:
+    """:return: 输出文件上次渲染时的 build key, 没有记录则返回空字符串."""
+    return load_output_keys().get(path, "")
+
+
+def set_output_key(path:str, key:str):
+    output_keys = load_output_keys()
+    with _lock:
+        output_keys[path] = key
+        get_conn().execute(
+            "INSERT OR REPLACE INTO outputs (path, key) VALUES (?, ?)",
+            (path, key))
+
+
+def commit():
+    if _conn is not None:
+        with _lock:
+            _conn.commit()
+
+
+def load_markdown() -> dict[str, str]:
+    rows = get_conn().execute("SELECT checksum, html FROM markdown")
+    return {row["checksum"]: row["html"] for row in rows}
+
+
+def save_markdown(items:dict[str, str]):
+    """用 items 替换 markdown 表的全部内容"""
+    conn = get_conn()
+    with _lock:
+        conn.execute("DELETE FROM markdown")
+        conn.executemany(
+            "INSERT INTO markdown (checksum, html) VALUES (?, ?)", items.items())
+
+
+def load_file_checksums() -> dict[str, tuple[int, int, int, str]]:
+    """:return: dict(path: (filesize, mtime_ns, inode, md5))"""
+    rows = get_conn().execute(
+        "SELECT path, filesize, mtime_ns, inode, md5 FROM file_checksums")
+    return {row["path"]: tuple(row)[1:] for row in rows}
+
+
+def save_file_checksums(items:dict[str, tuple[int, int, int, str]]):
+    """用 items 替换 file_checksums 表的全部内容"""
+    conn = get_conn()
+    with _lock:
+        conn.execute("DELETE FROM file_checksums")
+        conn.executemany(
+            "INSERT INTO file_checksums (path, filesize, mtime_ns, inode, md5) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(path, *record) for path, record in items.items()])
+
+
+def get_album_images(album:str) -> dict[str, dict]:
+    """:return: dict(图片文件名: 记录)"""
+    rows = get_conn().execute(
+        "SELECT * FROM images WHERE album=?", (album,))
+    return {row["name"]: dict(row) for row in rows}
+
+
+def save_image(album:str, name:str, info:ImageInfo) -> dict:
+    """新增或更新图片信息 (保留 thumb, ctime 等记录), 返回更新后的记录."""
+    columns = ", ".join(Image_Info_Columns)
+    marks = ", ".join("?" * len(Image_Info_Columns))
+    updates = ", ".join(f"{col}=excluded.{col}" for col in Image_Info_Columns)
+    values = [getattr(info, col) for col in Image_Info_Columns]
+    conn = get_conn()
+    conn.execute(
+        f"INSERT INTO images (album, name, {columns}) VALUES (?, ?, {marks}) "
+        f"ON CONFLICT(album, name) DO UPDATE SET {updates}",
+        [album, name, *values],
+    )
+    row = conn.execute(
+        "SELECT * FROM images WHERE album=? AND name=?", (album, name)
+    ).fetchone()
+    return dict(row)
+
+
+def set_thumb(album:str, name:str, checksum:str):
+    get_conn().execute(
+        "UPDATE images SET thumb=? WHERE album=? AND name=?",
+        (checksum, album, name),
+    )
+
+
+def set_derivs(album:str, name:str, signature:str):
+    get_conn().execute(
+        "UPDATE images SET derivs=? WHERE album=? AND name=?",
+        (signature, album, name),
+    )
+
+
+def set_ctime(album:str, name:str, toml_mtime_ns:int, ctime:str):
+    get_conn().execute(
+        "UPDATE images SET toml_mtime_ns=?, ctime=? WHERE album=? AND name=?",
+        (toml_mtime_ns, ctime, album, name),
+    )
+
+
+def delete_images(album:str, names:list[str]):
+    get_conn().executemany(
+        "DELETE FROM images WHERE album=? AND name=?",
+        [(album, name) for name in names],
+    )
+
+
+def delete_album_images(album:str):
+    get_conn().execute("DELETE FROM images WHERE album=?", (album,))
+    commit()
+
+
+def record_to_info(record:dict) -> ImageInfo:
+    return ImageInfo(**{col: record[col] for col in Image_Info_Columns})
@@ -2,7 +2,7 @@ from pathlib import Path
 
 import click
 
-from . import __version__, util, r2
+from . import __version__, util, r2, serve as preview, watch as watcher
 from .const import Gallery_Toml_Path
 from .util import print_err, print_err_exist, get_gallery
 
@@ -67,8 +67,18 @@ def show_info(ctx):
     help="Create a new album."
 )
 @click.option("--use-proxy", help="Set '1' or 'on' or 'true' to use proxy.")
+@click.option(
+    "-j", "--jobs",
+    type=int,
+    help="Number of processes/threads for processing pictures and "
+         "rendering pages (default: CPU count)."
+)
+@click.option(
+    "--targets",
+    help="Comma-separated output targets to render: r2,local,web (default: all)."
+)
 @click.pass_context
-def cli(ctx, info, update, force_resize, new_album, use_proxy):
+def cli(ctx, info, update, force_resize, new_album, use_proxy, jobs, targets):
     """R2-Gallery: 个人独立相册，采用 Cloudflare R2 作为图片储存。
 
     https://github.com/ahui2016/R2-Gallery/
@@ -83,26 +93,29 @@ def cli(ctx, info, update, force_resize, new_album, use_proxy):
         ctx.exit()
 
     if update:
+        targets, err = util.get_targets(targets)
+        print_err_exist(ctx, err)
         gallery = get_gallery(ctx)
         albums_pics = util.get_all_albums_pictures(gallery)
         if util.check_all_bad_names(albums_pics) > 0:
             ctx.exit()
         if util.check_all_double_names(albums_pics) > 0:
             ctx.exit()
-        if util.update_all_albums(albums_pics, gallery):
+        jobs = util.get_jobs(jobs)
+        if util.update_all_albums(albums_pics, gallery, jobs):
             ctx.exit()
 
         err = util.check_all_albums_cover(albums_pics)
         print_err_exist(ctx, err)
 
-        util.render_all(albums_pics, gallery)
+        util.render_all(albums_pics, gallery, jobs=jobs, targets=targets)
         ctx.exit()
 
     if force_resize:
         click.confirm("注意，强制缩小图片有可能覆盖原图，请先备份原图。确认执行吗？", abort=True)
         gallery = get_gallery(ctx)
         albums_pics = util.get_all_albums_pictures(gallery)
-        util.resize_all_albums_pics(albums_pics, gallery)
+        util.resize_all_albums_pics(albums_pics, gallery, util.get_jobs(jobs))
         ctx.exit()
 
     if new_album:
@@ -148,28 +161,101 @@ def delete(ctx, name):
     ctx.exit()
 
 
+@cli.command(context_settings=CONTEXT_SETTINGS)
+@click.option(
+    "-j", "--jobs",
+    type=int,
+    help="Number of processes/threads (default: CPU count)."
+)
+@click.option(
+    "--targets",
+    help="Comma-separated output targets to render: r2,local,web (default: all)."
+)
+@click.option("--poll", is_flag=True, help="Poll the folders instead of using inotify.")
+@click.option(
+    "--interval",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Polling interval in seconds."
+)
+@click.pass_context
+def watch(ctx, jobs, targets, poll, interval):
+    """Watch the gallery and rebuild changed albums.
+
+    监视图库, 有变化时自动更新 (相当于只处理有变化的相册的 'r2g -update')。
+    """
+    targets, err = util.get_targets(targets)
+    print_err_exist(ctx, err)
+    gallery = get_gallery(ctx)
+    try:
+        watcher.watch_gallery(
+            gallery, watcher.get_watcher(poll, interval), util.get_jobs(jobs), targets)
+    except KeyboardInterrupt:
+        print("\n已停止监视。")
+    ctx.exit()
+
+
+@cli.command(context_settings=CONTEXT_SETTINGS)
+@click.option("--host", default="127.0.0.1", show_default=True, help="Host to bind.")
+@click.option("--port", type=int, default=8000, show_default=True, help="Port to bind.")
+@click.option(
+    "--cache-size",
+    type=int,
+    default=512,
+    show_default=True,
+    help="Max number of rendered pages (and thumbnails) kept in memory."
+)
+@click.pass_context
+def serve(ctx, host, port, cache_size):
+    """Preview the gallery in a browser.
+
+    本地预览图库: 网页在浏览时才生成, 不写入 output 文件夹。
+    """
+    gallery = get_gallery(ctx)
+    try:
+        preview.serve_gallery(gallery, host, port, cache_size)
+    except KeyboardInterrupt:
+        print("\n已停止预览。")
+    ctx.exit()
+
+
 @cli.command(context_settings=CONTEXT_SETTINGS)
 @click.option("all_files", "-all", is_flag=True, help="Upload pictures and assets.")
 @click.option("-pics", is_flag=True, help="Upload pictures.")
 @click.option("-assets", is_flag=True, help="Upload assets.")
+@click.option(
+    "-j", "--jobs",
+    type=int,
+    help="Number of files to upload at the same time (default: upload_jobs in gallery.toml)."
+)
 @click.pass_context
-def upload(ctx, all_files, pics, assets):
+def upload(ctx, all_files, pics, assets, jobs):
     """Upload pictures or static files.
 
     上传图片或 HTML/CSS 等文件。
     """
     gallery = get_gallery(ctx)
+    encoding, err = r2.get_content_encoding(gallery)
+    print_err_exist(ctx, err)
+    jobs, err = r2.get_upload_jobs(gallery, jobs)
+    print_err_exist(ctx, err)
+    transfer, err = r2.get_transfer_config(gallery)
+    print_err_exist(ctx, err)
 
     if all_files:
-        bucket = r2.get_bucket(gallery)
-        r2.upload_pics(bucket)
-        r2.upload_assets(bucket)
+        bucket = r2.get_bucket(gallery, jobs)
+        r2.delete_pending_objects(bucket)
+        r2.upload_pics(bucket, jobs, transfer)
+        r2.upload_assets(bucket, encoding, jobs)
     elif pics:
-        bucket = r2.get_bucket(gallery)
-        r2.upload_pics(bucket)
+        bucket = r2.get_bucket(gallery, jobs)
+        r2.delete_pending_objects(bucket)
+        r2.upload_pics(bucket, jobs, transfer)
     elif assets:
-        bucket = r2.get_bucket(gallery)
-        r2.upload_assets(bucket)
+        bucket = r2.get_bucket(gallery, jobs)
+        r2.delete_pending_objects(bucket)
+        r2.upload_assets(bucket, encoding, jobs)
     else:
         click.echo(ctx.get_help())
     ctx.exit()
@@ -1,6 +1,6 @@
 import hashlib
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum, auto
 from pathlib import Path
 
@@ -9,11 +9,15 @@ import tomli
 import mistune
 
 from .const import Gallery_Toml_Path, RFC3339, Metadata, Dot_Toml, CWD, \
-    Album_Toml, Dot_JPEG, Index_HTML, Dot_HTML, Thumbs
+    Album_Toml, Dot_JPEG, Index_HTML, Dot_HTML, Thumbs, Dot_WebP
 
 Filename_Forbid_Pattern = re.compile(r"[^._0-9a-zA-Z\-]")
 """文件名只能使用 0-9, a-z, A-Z, _(下划线), -(短横线), .(点)。"""
 
+Index_Page_Pattern = re.compile(r"index2?(-([2-9]|[1-9]\d+))?")
+"""相册索引页的文件名 (index, index2, index-2, index2-3 ...), 图片不可使用这些文件名.
+分页从第二页起才带页码 (详见 util.get_page_name), 因此 index-1, index1 等仍可使用."""
+
 Short_Notes_Limit = 512
 """简单描述的长度上限，单位: UTF8字符"""
 
@@ -57,6 +61,92 @@ def now():
     return arrow.now().format(RFC3339)
 
 
+class IdentityMap:
+    """toml 文件路径 -> 已解析的对象 (Picture/Album).
+
+    在一次运行中, 每个 toml 最多读取并解析一次, 之后都返回同一个对象.
+    写入 toml 时也要通过 put 更新, 以保持与文件内容一致.
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, toml_path:Path):
+        return self.objects.get(str(toml_path))
+
+    def put(self, toml_path:Path, obj):
+        self.objects[str(toml_path)] = obj
+
+    def forget(self, toml_path:Path):
+        self.objects.pop(str(toml_path), None)
+
+    def clear(self):
+        self.objects.clear()
+
+
+toml_map = IdentityMap()
+
+
+class MarkdownCache:
+    """story 的 Markdown -> HTML, 以 story 的 checksum 为 key.
+
+    图库, 相册及图片每次生成 data 时都要转换 story, 没有变化的 story 直接使用缓存.
+    load 与 used_items 用于把缓存保存到数据库 (详见 util.render_all).
+    """
+    def __init__(self):
+        self.html_map = {}
+        self.used = set()
+
+    def load(self, items:dict[str, str]):
+        self.html_map.update(items)
+
+    def html(self, text:str) -> str:
+        if not text:
+            return ""
+        key = text_checksum(text)
+        self.used.add(key)
+        html = self.html_map.get(key)
+        if html is None:
+            html = mistune.html(text)
+            self.html_map[key] = html
+        return html
+
+    def used_items(self) -> dict[str, str]:
+        """本次运行用到的缓存, 不再使用的旧缓存不保存."""
+        return {key: self.html_map[key] for key in self.used}
+
+
+markdown_cache = MarkdownCache()
+
+
+@dataclass
+class FileStat:
+    """os.scandir 扫描文件夹时得到的文件信息 (详见 util.scan_files)"""
+    size     : int  # 文件体积, 单位: byte
+    mtime_ns : int  # 文件修改时间, 单位: 纳秒
+
+
+@dataclass
+class ImageInfo:
+    """读取图片文件头得到的信息, 供检查体积, 生成 toml 及缩略图共用"""
+    filesize    : int  # 文件体积, 单位: byte
+    mtime_ns    : int  # 文件修改时间, 单位: 纳秒
+    checksum    : str  # sha1, 文件内容的 checksum
+    width       : int  # 单位: 像素 (未考虑 orientation)
+    height      : int  # 单位: 像素 (未考虑 orientation)
+    format      : str  # PIL 识别的图片格式, 例如 JPEG, PNG (空字符串表示不是图片)
+    orientation : int  # EXIF Orientation, 没有则为 1
+    datetime    : str  # EXIF 拍摄日期 (RFC3339), 没有则为空字符串
+
+    def is_image(self):
+        return bool(self.format)
+
+    def display_width(self):
+        """摆正 (考虑 orientation) 后的宽度"""
+        if self.orientation in (5, 6, 7, 8):
+            return self.height
+        return self.width
+
+
 @dataclass
 class PictureData:
     """用于生成前端 HTML"""
@@ -69,6 +159,10 @@ class PictureData:
     r2_html       : str  # 图片页面的 R2 对象名
     r2_pic_name   : str  # 图片本身的 R2 对象名
     r2_thumb_name : str  # 缩略图的 R2 对象名
+    width         : int  = 0  # 图片宽度 (摆正后), 用于 srcset
+    deriv_widths  : list = field(default_factory=list)  # 已生成的缩小版本的宽度
+    deriv_webp    : bool = False  # 缩小版本是否同时有 WebP 格式
+    deriv_suffix  : str  = Dot_JPEG  # 缩小版本的后缀名 (Gallery.thumb_suffix)
 
 
 @dataclass
@@ -92,11 +186,14 @@ class Picture:
 
     @classmethod
     def loads(cls, toml_path:Path):
-        """Loads TOML to a Picture."""
+        """Loads TOML to a Picture. (每次运行只解析一次, 详见 toml_map)"""
+        if pic := toml_map.get(toml_path):
+            return pic
         data = tomli_loads(toml_path)
         pic = Picture(**data)
         pic.notes = pic.notes.strip()
         pic.story = pic.story.strip()
+        toml_map.put(toml_path, pic)
         return pic
 
     def make_checksum(self):
@@ -108,8 +205,11 @@ class Picture:
         pic_title, _, _ = split_notes(self.notes)
         return pic_title
 
-    def to_data(self, pic_path:Path) -> PictureData:
-        """pic_name 是图片文件名, 包括后缀, 不包括文件夹."""
+    def to_data(self, pic_path:Path, deriv_data:dict=None) -> PictureData:
+        """pic_name 是图片文件名, 包括后缀, 不包括文件夹.
+
+        deriv_data 是与缩小版本 (响应式图片) 有关的项目, 详见 util.get_deriv_data
+        """
         title, notes, _ = split_notes(self.notes)
         file_id = pic_path.stem.lower()
         pic_name = pic_path.name
@@ -119,11 +219,12 @@ class Picture:
             filename=pic_name,
             title=title,
             notes=notes,
-            story=mistune.html(self.story),
+            story=markdown_cache.html(self.story),
             ctime=self.ctime,
             r2_html=f"{album_folder}/{file_id+Dot_HTML}",
             r2_pic_name=f"{album_folder}/{pic_name}",
             r2_thumb_name=f"{album_folder}/{Thumbs}/{file_id+Dot_JPEG}",
+            **(deriv_data or {}),
         )
 
 
@@ -143,6 +244,15 @@ class AlbumData:
     cover_title        : str  # 提取自 Album.cover 的 notes
 
 
+@dataclass
+class PageData:
+    """用于生成分页的索引页 (图库首页及相册索引页)"""
+    num   : int  # 页码, 从 1 开始
+    total : int  # 总页数
+    prev  : str  # 上一页的文件名, 空字符串表示没有上一页
+    next  : str  # 下一页的文件名, 空字符串表示没有下一页
+
+
 @dataclass
 class Album:
     author     : str  # 作者, 留空表示跟随图库作者
@@ -153,6 +263,9 @@ class Album:
     cover      : str  # 封面 (指定一个图片文件名)
     frontpage  : str  # 默认 Frontpage.Story
     checksum   : str  # sha1, 用来判断相册首页 HTML 要不要更新
+    # 相册索引页每页的图片数量, 0 表示不分页.
+    # 旧的 album.toml 没有该项, 其模板也没有翻页链接, 因此默认不分页 (新相册见 default)
+    page_size  : int = 0
 
     @classmethod
     def default(cls, foldername):
@@ -165,17 +278,21 @@ class Album:
             cover="",
             frontpage=Frontpage.Story.name,
             checksum="",
+            page_size=100,
         )
 
     @classmethod
     def loads(cls, toml_path:Path):
-        """Loads TOML to an Album."""
+        """Loads TOML to an Album. (每次运行只解析一次, 详见 toml_map)"""
+        if album := toml_map.get(toml_path):
+            return album
         data = tomli_loads(toml_path)
         album = Album(**data)
         album.notes = album.notes.strip()
         album.story = album.story.strip()
         album.frontpage = album.frontpage.capitalize()
         album.sort_by = sort_by_from(album.sort_by).name
+        toml_map.put(toml_path, album)
         return album
 
     def delete_pic(self, pic_name:str):
@@ -190,7 +307,7 @@ class Album:
     def make_checksum(self):
         pictures = ''.join(self.pictures)
         text = self.author + self.notes + self.story + self.sort_by + pictures \
-               + self.cover + self.frontpage
+               + self.cover + self.frontpage + str(self.page_size)
         return text_checksum(text)
 
     def index_html_name(self):
@@ -214,7 +331,7 @@ class Album:
             author=self.author,
             title=title,
             notes=notes,
-            story=mistune.html(self.story),
+            story=markdown_cache.html(self.story),
             sort_by=self.sort_by,
             r2_html=f"{foldername}/{Index_HTML}",
             cover_thumb_r2=f"{foldername}/thumbs/{cover_thumb_name}",
@@ -257,6 +374,24 @@ class Gallery:
     bucket_name           : str
     bucket_url            : str
 
+    # 响应式图片: 为每张图片生成以下宽度的缩小版本 (比原图窄的才生成), 单位: 像素
+    derivative_widths : list = field(default_factory=list)
+    derivative_webp   : bool = False  # 缩小版本是否同时生成 WebP 格式
+
+    # 图库首页每页的相册数量, 0 表示不分页.
+    # 旧的 gallery.toml 没有该项, 其模板也没有翻页链接, 因此默认不分页 (新图库见 default)
+    albums_per_page : int = 0
+
+    compress_assets : str = ""  # 上传 HTML/JS/CSS 时预先压缩: '' (不压缩) / 'gzip' / 'br'
+    minify_r2       : bool = False  # 是否压缩 output_r2 里的网页的空白
+
+    upload_jobs : int = 8  # 同时上传的文件数量
+
+    # 大文件分块上传 (可断点续传), 单位: MB
+    multipart_threshold   : int = 16  # 超过该体积的文件分块上传
+    multipart_chunksize   : int = 8   # 每块的体积 (不可小于 5)
+    multipart_concurrency : int = 4   # 一个文件同时上传的块数
+
     @classmethod
     def default(cls, title:str):
         author = "佚名"
@@ -279,6 +414,10 @@ class Gallery:
             aws_secret_access_key = '<access_key_secret>',
             bucket_name = '<bucket_name>',
             bucket_url = '<bucket_url>',
+            derivative_widths=[480, 800],
+            derivative_webp=True,
+            albums_per_page=50,
+            minify_r2=True,
         )
 
     @classmethod
@@ -305,7 +444,7 @@ class Gallery:
             author=self.author,
             title=title,
             notes=notes,
-            story=mistune.html(self.story),
+            story=markdown_cache.html(self.story),
             frontpage=self.frontpage,
             bucket_url=self.bucket_url,
         )
@@ -319,7 +458,8 @@ class Gallery:
 
     def make_checksum(self):
         albums = ''.join(self.albums)
-        text = self.author + self.notes + self.story + self.frontpage + albums
+        text = self.author + self.notes + self.story + self.frontpage + albums \
+               + str(self.albums_per_page)
         return text_checksum(text)
 
     def add_album(self, album_name:str):
@@ -332,6 +472,25 @@ class Gallery:
     def thumb_suffix(self):
         return f".{self.image_output_format.lower()}"
 
+    def deriv_widths(self, info:ImageInfo) -> list[int]:
+        """一张图片需要生成的缩小版本的宽度 (从大到小)"""
+        width = info.display_width()
+        return sorted((w for w in set(self.derivative_widths) if w < width),
+                      reverse=True)
+
+    def deriv_formats(self) -> list[tuple[str, str]]:
+        """:return: [(后缀名, PIL 图片格式)]"""
+        formats = [(self.thumb_suffix(), self.image_output_format)]
+        if self.derivative_webp:
+            formats.append((Dot_WebP, ImageFormat.WebP.name))
+        return formats
+
+    def deriv_signature(self, info:ImageInfo) -> str:
+        """记录在 db.images.derivs, 图片内容或设定有变化时需要重新生成缩小版本."""
+        widths = ",".join(map(str, self.deriv_widths(info)))
+        formats = ",".join(suffix for suffix, _ in self.deriv_formats())
+        return f"{info.checksum} {widths} {formats}"
+
     def index_html_name(self):
         return f"index_{self.frontpage.lower()}.html"
 
@@ -339,9 +498,14 @@ class Gallery:
         if album_folder in self.albums:
             self.albums.remove(album_folder)
 
-    def get_albumdata(self):
+    def get_albumdata(self, known:dict[str, AlbumData]=None):
+        """known 是已生成的 AlbumData (相册名: AlbumData), 不必重新生成."""
+        known = known or {}
         albums = []
         for album_name in self.albums:
+            if album_name in known:
+                albums.append(known[album_name])
+                continue
             album_path = CWD.joinpath(album_name)
             album_toml_path = album_path.joinpath(Album_Toml)
             album = Album.loads(album_toml_path)
@@ -1,28 +1,101 @@
+import gzip
 import hashlib
+import io
 import json
+import math
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 from typing import Iterable
 
 import boto3
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
-from botocore.exceptions import BotoCoreError
+from botocore.exceptions import BotoCoreError, ClientError
 
-from .const import R2_Files_JSON_Path, R2_Waiting_JSON_Path, Thumbs, Output_R2_Path
+try:
+    import brotli
+except ImportError:
+    brotli = None
+"""brotli 是可选依赖 (pip install brotli), 用于 compress_assets = 'br'"""
 
+from . import db
+from .const import CWD, R2_Files_JSON_Path, R2_Waiting_JSON_Path, Thumbs, Output_R2_Path, \
+    Derivs, R2_Multipart_JSON_Path, R2_Journal_Path, R2_Deleting_JSON_Path, MB
 
-def get_bucket(cfg):
-    s3 = get_s3(cfg)
+Content_Encodings = ("gzip", "br")
+Compress_Suffixes = (".html", ".js", ".css")
+"""只压缩这些文本文件, 图片本身已经是压缩格式."""
+
+Default_Pool_Connections = 10
+"""botocore 默认的连接池大小, 同时上传的文件数量更多时需要相应增大."""
+
+Multipart_Chunksize_Min = 5
+"""S3/R2 规定除最后一块外, 每块不可小于 5 MB"""
+
+_multipart_lock = threading.Lock()
+"""多个线程同时上传分块时, 用于保护 r2_multipart.json"""
+
+Upload_Retries = 3
+Retry_Delay = 1.0
+"""上传失败时最多重试 Upload_Retries 次, 依次等待 1, 2, 4 秒 (Retry_Delay 乘以 2 的次方)"""
+
+Upload_Errors = (BotoCoreError, ClientError, S3UploadFailedError, OSError)
+"""上传时可能出现的错误 (网络错误, 云端返回的错误, 读取文件失败)"""
+
+
+def get_bucket(cfg, jobs:int=1):
+    """jobs 是同时上传的文件数量, 用于设定连接池的大小."""
+    s3 = get_s3(cfg, jobs)
     return s3.Bucket(cfg.bucket_name)
 
 
-def get_s3(cfg):
+def get_s3(cfg, jobs:int=1):
+    """每个文件最多同时上传 multipart_concurrency 块, 连接池大小按此计算."""
+    pool_size = jobs * max(1, cfg.multipart_concurrency)
     return boto3.resource(
         's3',
         endpoint_url=cfg.endpoint_url,
         aws_access_key_id=cfg.aws_access_key_id,
         aws_secret_access_key=cfg.aws_secret_access_key,
-        config=Config(proxies=get_proxies(cfg)),
+        config=Config(
+            proxies=get_proxies(cfg),
+            max_pool_connections=max(Default_Pool_Connections, pool_size),
+        ),
+    )
+
+
+def get_upload_jobs(cfg, jobs:int|None) -> (int, str):
+    """命令行的 --jobs 优先, 否则采用 gallery.toml 中的 upload_jobs.
+
+    :return: (jobs, err)
+    """
+    jobs = jobs or cfg.upload_jobs
+    if jobs < 1:
+        return 0, f"upload_jobs 必须大于零, 不能是 {jobs}"
+    return jobs, None
+
+
+def get_transfer_config(cfg) -> (TransferConfig|None, str):
+    """根据 gallery.toml 中的 multipart_* 设定生成 TransferConfig.
+
+    :return: (transfer, err)
+    """
+    if cfg.multipart_chunksize < Multipart_Chunksize_Min:
+        return None, f"multipart_chunksize 不可小于 {Multipart_Chunksize_Min} (MB)"
+    if cfg.multipart_threshold < 1 or cfg.multipart_concurrency < 1:
+        return None, "multipart_threshold 与 multipart_concurrency 必须大于零"
+    transfer = TransferConfig(
+        multipart_threshold=cfg.multipart_threshold * MB,
+        multipart_chunksize=cfg.multipart_chunksize * MB,
+        max_concurrency=cfg.multipart_concurrency,
     )
+    return transfer, None
 
 
 def get_proxies(cfg):
@@ -31,17 +104,58 @@ def get_proxies(cfg):
     return None
 
 
-def add_pics_to_r2_waiting(new_pics:Iterable):
-    waiting = get_r2_waiting()
+def add_pics_to_r2_waiting(new_pics:Iterable, removed_pics:Iterable=()):
+    """removed_pics 是已删除 (因此不必再上传) 的文件."""
+    waiting = get_r2_waiting().difference(removed_pics)
     write_r2_waiting(waiting.union(new_pics))
 
 
+def add_to_r2_deleting(obj_names:Iterable):
+    """记录需要从云端删除的对象, 等执行 `r2g upload` 时才删除 (详见 delete_pending_objects)."""
+    deleting = get_r2_deleting().union(obj_names)
+    write_text_atomic(R2_Deleting_JSON_Path, json.dumps(sorted(deleting)))
+
+
+def get_r2_deleting() -> set:
+    """:return: set(obj_name)"""
+    if R2_Deleting_JSON_Path.exists():
+        return set(json.loads(R2_Deleting_JSON_Path.read_text()))
+    return set()
+
+
+def delete_pending_objects(bucket):
+    """从云端删除 r2_deleting.json 中的对象, 删除失败的留待下次再删."""
+    deleting = get_r2_deleting()
+    if not deleting:
+        return
+    names = sorted(deleting)
+    failed = set()
+    try:
+        # delete_objects 每次最多删除 1000 个对象
+        for i in range(0, len(names), 1000):
+            failed |= delete_objects(set(names[i:i+1000]), bucket)
+    except Upload_Errors as err:
+        print(f"未删除云端文件: {err}")
+        return
+    if failed:
+        write_text_atomic(R2_Deleting_JSON_Path, json.dumps(sorted(failed)))
+    else:
+        R2_Deleting_JSON_Path.unlink()
+
+
 def write_r2_waiting(waiting:set):
-    R2_Waiting_JSON_Path.write_text(json.dumps(list(waiting)))
+    """写入前先合并上传日志, 以免日志中的旧记录影响新的 waiting"""
+    compact_journal()
+    write_text_atomic(R2_Waiting_JSON_Path, json.dumps(sorted(waiting)))
 
 
 def get_r2_waiting() -> set:
-    """:return: set(pic_path:str)"""
+    """:return: set(pic_path:str), 已删除上传日志中已上传的图片"""
+    uploaded, _ = read_journal()
+    return read_r2_waiting().difference(uploaded)
+
+
+def read_r2_waiting() -> set:
     if R2_Waiting_JSON_Path.exists():
         waiting = json.loads(R2_Waiting_JSON_Path.read_text())
         return set(waiting)
@@ -49,16 +163,81 @@ def get_r2_waiting() -> set:
 
 
 def write_r2_files_json(r2_files:dict):
-    data = json.dumps(r2_files)
-    R2_Files_JSON_Path.write_text(data)
+    """写入前先合并上传日志, 理由同 write_r2_waiting"""
+    compact_journal()
+    write_text_atomic(R2_Files_JSON_Path, json.dumps(r2_files))
 
 
 def get_r2_files() -> dict:
+    """已采用上传日志中的新 checksum"""
+    r2_files = read_r2_files()
+    _, checksums = read_journal()
+    r2_files.update(checksums)
+    return r2_files
+
+
+def read_r2_files() -> dict:
     if R2_Files_JSON_Path.exists():
         return json.loads(R2_Files_JSON_Path.read_text())
     return {}
 
 
+def write_text_atomic(file:Path, text:str):
+    """先写入临时文件再替换, 中途中断也不会留下写了一半的文件."""
+    temp = file.with_name(file.name + ".tmp")
+    temp.write_text(text)
+    os.replace(temp, file)
+
+
+def append_journal(entry:dict):
+    """上传日志 (r2_journal.jsonl) 每上传成功一个文件就追加一行, 并立即写入磁盘,
+    因此上传中断 (甚至断电) 也不会丢失已上传的记录.
+
+    entry 是 dict(pic=pic_path) 或 dict(asset=obj_name, checksum=checksum).
+    只在主线程中调用 (详见 upload_concurrently).
+    """
+    with open(R2_Journal_Path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_journal() -> (set, dict):
+    """:return: (已上传的图片, dict(已上传的 obj_name: checksum))"""
+    uploaded = set()
+    checksums = {}
+    if not R2_Journal_Path.exists():
+        return uploaded, checksums
+    for line in R2_Journal_Path.read_text(encoding="utf-8").splitlines():
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue  # 写入中断的最后一行
+        if "pic" in entry:
+            uploaded.add(entry["pic"])
+        elif "asset" in entry:
+            checksums[entry["asset"]] = entry["checksum"]
+    return uploaded, checksums
+
+
+def compact_journal():
+    """把上传日志合并到 r2_waiting.json 及 r2_files.json, 然后删除日志.
+
+    若在删除日志前中断, 下次会再合并一次, 结果相同.
+    """
+    if not R2_Journal_Path.exists():
+        return
+    uploaded, checksums = read_journal()
+    if uploaded:
+        waiting = read_r2_waiting().difference(uploaded)
+        write_text_atomic(R2_Waiting_JSON_Path, json.dumps(sorted(waiting)))
+    if checksums:
+        r2_files = read_r2_files()
+        r2_files.update(checksums)
+        write_text_atomic(R2_Files_JSON_Path, json.dumps(r2_files))
+    R2_Journal_Path.unlink()
+
+
 def add_to_r2_files(obj_names: list[str]):
     """obj_names 是 obj_name 的列表.
 
@@ -73,13 +252,6 @@ def add_to_r2_files(obj_names: list[str]):
     write_r2_files_json(r2_files)
 
 
-def update_r2_files(new_r2_files:dict):
-    old_r2_files = get_r2_files()
-    for obj_name, checksum in new_r2_files.items():
-        old_r2_files[obj_name] = checksum
-    write_r2_files_json(old_r2_files)
-
-
 def delete_from_r2_files(name:str, r2_files:dict):
     del r2_files[name]
     write_r2_files_json(r2_files)
@@ -103,66 +275,308 @@ def rename_obj(old_name:str, new_name:str, bucket):
     bucket.delete_objects(Delete={"Objects": [dict(Key=old_name)]})
 
 
-def upload_file(file:str, obj_name:str, bucket) -> bool:
-    """返回 False 表示上传失败。"""
+def upload_file(
+        file:str,
+        obj_name:str,
+        bucket,
+        extra_args:dict=None,
+        transfer:TransferConfig=None
+) -> bool:
+    """返回 False 表示上传失败。
+
+    采用 bucket.meta.client 上传, 因为 boto3 的 client 可以在多个线程中共用
+    (resource 对象则不保证线程安全), 详见 upload_concurrently.
+    """
     success = True
     try:
-        bucket.upload_file(file, obj_name)
-    except BotoCoreError as err:
+        bucket.meta.client.upload_file(
+            file, bucket.name, obj_name, ExtraArgs=extra_args, Config=transfer)
+    except Upload_Errors as err:
         print(err)
         success = False
     return success
 
 
-def upload_pic(pic_path:str, bucket):
+def upload_bytes(data:bytes, obj_name:str, bucket, extra_args:dict=None) -> bool:
     """返回 False 表示上传失败。"""
+    success = True
+    try:
+        bucket.meta.client.upload_fileobj(
+            io.BytesIO(data), bucket.name, obj_name, ExtraArgs=extra_args)
+    except Upload_Errors as err:
+        print(err)
+        success = False
+    return success
+
+
+def get_content_encoding(cfg) -> (str, str):
+    """检查 gallery.toml 中的 compress_assets, 返回 (encoding, err).
+
+    encoding 是空字符串表示不压缩.
+    """
+    encoding = cfg.compress_assets.strip().lower()
+    if not encoding:
+        return "", None
+    if encoding not in Content_Encodings:
+        return "", f"compress_assets 只能是 '', 'gzip' 或 'br', 不能是 '{encoding}'"
+    if encoding == "br" and brotli is None:
+        return "", "compress_assets = 'br' 需要先安装 brotli (pip install brotli)"
+    return encoding, None
+
+
+def compress(data:bytes, encoding:str) -> bytes:
+    """压缩结果是确定的 (gzip 不记录时间), 内容不变则压缩结果也不变."""
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    if encoding == "br":
+        return brotli.compress(data)
+    return data
+
+
+def should_compress(filepath:Path, encoding:str) -> bool:
+    return bool(encoding) and filepath.suffix.lower() in Compress_Suffixes
+
+
+def get_content_type(filepath:Path) -> str:
+    content_type, _ = mimetypes.guess_type(filepath.name)
+    if content_type is None:
+        return "application/octet-stream"
+    if content_type.startswith("text/") or content_type.endswith("javascript"):
+        return content_type + "; charset=utf-8"
+    return content_type
+
+
+def upload_asset(filepath:Path, obj_name:str, bucket, encoding:str="") -> bool:
+    """上传 HTML/CSS 等文件, 并设置 Content-Type.
+    encoding 不为空时, 先在内存中压缩, 再以 Content-Encoding 上传.
+    返回 False 表示上传失败。
+    """
+    extra_args = dict(ContentType=get_content_type(filepath))
+    if not should_compress(filepath, encoding):
+        return upload_file(str(filepath), obj_name, bucket, extra_args)
+    extra_args["ContentEncoding"] = encoding
+    data = compress(filepath.read_bytes(), encoding)
+    return upload_bytes(data, obj_name, bucket, extra_args)
+
+
+def get_multipart_state() -> dict:
+    """:return: dict(obj_name: 分块上传记录), 详见 upload_resumable"""
+    if not R2_Multipart_JSON_Path.exists():
+        return {}
+    try:
+        return json.loads(R2_Multipart_JSON_Path.read_text())
+    except json.JSONDecodeError:
+        # 文件损坏时当作没有记录, 只是分块上传要从头开始, 不应导致无法上传
+        print(f"Warning: 无法读取 {R2_Multipart_JSON_Path.name}, 分块上传将从头开始")
+        return {}
+
+
+def set_multipart_state(obj_name:str, record:dict|None):
+    """更新 (record 为 None 时删除) 一个文件的分块上传记录, 全部上传完成后删除 json 文件.
+
+    调用时须持有 _multipart_lock.
+    """
+    state = get_multipart_state()
+    if record is None:
+        state.pop(obj_name, None)
+    else:
+        state[obj_name] = record
+    if state:
+        write_text_atomic(R2_Multipart_JSON_Path, json.dumps(state, indent=2))
+    elif R2_Multipart_JSON_Path.exists():
+        R2_Multipart_JSON_Path.unlink()
+
+
+def upload_resumable(file:str, obj_name:str, bucket, transfer:TransferConfig) -> bool:
+    """分块上传大文件, 每上传一块就记录在 r2_multipart.json,
+    中断后再次上传时, 只上传未完成的块.
+
+    文件的体积, 修改时间或 multipart_chunksize 有变化时, 放弃旧的记录, 从头上传.
+    返回 False 表示上传失败。
+    """
+    client = bucket.meta.client
+    stat = os.stat(file)
+    chunksize = transfer.multipart_chunksize
+    with _multipart_lock:
+        record = get_multipart_state().get(obj_name)
+    try:
+        if record is None or (record["size"], record["mtime_ns"], record["chunksize"]) \
+                != (stat.st_size, stat.st_mtime_ns, chunksize):
+            if record is not None:
+                abort_multipart_upload(obj_name, record["upload_id"], bucket)
+            resp = client.create_multipart_upload(Bucket=bucket.name, Key=obj_name)
+            record = dict(upload_id=resp["UploadId"], size=stat.st_size,
+                          mtime_ns=stat.st_mtime_ns, chunksize=chunksize, parts={})
+            with _multipart_lock:
+                set_multipart_state(obj_name, record)
+        elif record["parts"]:
+            print(f"resume -> {file} (已上传 {len(record['parts'])} 块)")
+
+        def upload_part(num:int):
+            with open(file, "rb") as f:
+                f.seek((num-1) * chunksize)
+                data = f.read(chunksize)
+            resp = client.upload_part(
+                Bucket=bucket.name, Key=obj_name, UploadId=record["upload_id"],
+                PartNumber=num, Body=data)
+            with _multipart_lock:
+                record["parts"][str(num)] = resp["ETag"]
+                set_multipart_state(obj_name, record)
+
+        total = max(1, math.ceil(stat.st_size / chunksize))
+        todo = [num for num in range(1, total+1) if str(num) not in record["parts"]]
+        with ThreadPoolExecutor(max_workers=transfer.max_concurrency) as executor:
+            list(executor.map(upload_part, todo))
+
+        parts = [dict(PartNumber=num, ETag=record["parts"][str(num)])
+                 for num in range(1, total+1)]
+        client.complete_multipart_upload(
+            Bucket=bucket.name, Key=obj_name, UploadId=record["upload_id"],
+            MultipartUpload=dict(Parts=parts))
+    except ClientError as err:
+        print(err)
+        if err.response.get("Error", {}).get("Code") == "NoSuchUpload":
+            # 云端已放弃该上传 (例如过期), 下次从头上传
+            with _multipart_lock:
+                set_multipart_state(obj_name, None)
+        return False
+    except (BotoCoreError, OSError) as err:
+        print(err)
+        return False
+
+    with _multipart_lock:
+        set_multipart_state(obj_name, None)
+    return True
+
+
+def abort_multipart_upload(obj_name:str, upload_id:str, bucket):
+    """放弃旧的分块上传, 以免已上传的块继续占用空间 (失败也不要紧)."""
+    try:
+        bucket.meta.client.abort_multipart_upload(
+            Bucket=bucket.name, Key=obj_name, UploadId=upload_id)
+    except (BotoCoreError, ClientError) as err:
+        print(err)
+
+
+def upload_pic(pic_path:str, bucket, transfer:TransferConfig=None):
+    """超过 transfer.multipart_threshold 的图片采用可断点续传的分块上传.
+    返回 False 表示上传失败。
+    """
     parts = Path(pic_path).parts
-    if parts[-2] == Thumbs:
+    if parts[-2] in (Thumbs, Derivs):
         obj_name = "/".join(parts[-3:])
     else:
         obj_name = "/".join(parts[-2:])
-    return upload_file(pic_path, obj_name, bucket)
+    try:
+        size = os.path.getsize(pic_path)
+    except OSError as err:
+        print(err)
+        return False
+    if transfer and size >= transfer.multipart_threshold:
+        return upload_resumable(pic_path, obj_name, bucket, transfer)
+    return upload_file(pic_path, obj_name, bucket, transfer=transfer)
 
 
-def upload_pics(bucket):
-    """上传图片及其缩略图到 Cloudflare R2"""
-    r2_waiting = get_r2_waiting()
+def upload_concurrently(tasks:dict, jobs:int, on_success) -> set:
+    """在 jobs 个线程中同时执行上传.
+
+    tasks 是 dict(本地文件路径: 上传函数), 上传函数不需要参数, 返回 False 表示上传失败.
+    失败的上传会重试 (详见 upload_with_retry), 仍然失败则跳过, 继续上传其他文件.
+    每上传成功一个文件, 就在主线程中调用 on_success(key).
+    :return: 上传成功的 key
+    """
     success = set()
-    for pic_path in r2_waiting:
-        print(f"upload -> {pic_path}")
-        if upload_pic(pic_path, bucket):
-            success.add(pic_path)
-        else:
-            print(f"上传失败: {pic_path}")
-            break
-    r2_waiting.difference_update(success)
-    write_r2_waiting(r2_waiting)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(upload_with_retry, task, key): key
+                   for key, task in tasks.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            if future.result():
+                print(f"upload -> {key}")
+                on_success(key)
+                success.add(key)
+            else:
+                print(f"上传失败: {key}")
+    failed = len(tasks) - len(success)
+    if failed:
+        print(f"有 {failed} 个文件上传失败, 请稍后再次执行上传命令.")
+    return success
+
 
+def upload_with_retry(task, key:str) -> bool:
+    """上传失败时等待一段时间再重试, 每次等待的时间加倍 (exponential backoff).
 
-def upload_assets(bucket):
-    """上传 HTML/CSS 等文件到 Cloudflare R2"""
+    key 是本地文件路径, 文件已不存在时不再重试.
+    """
+    for attempt in range(Upload_Retries + 1):
+        if attempt > 0:
+            if not os.path.exists(key):
+                return False
+            delay = Retry_Delay * 2 ** (attempt-1)
+            print(f"{delay:g} 秒后重试 ({attempt}/{Upload_Retries}): {key}")
+            time.sleep(delay)
+        if task():
+            return True
+    return False
+
+
+def upload_pics(bucket, jobs:int=1, transfer:TransferConfig=None):
+    """上传图片及其缩略图到 Cloudflare R2
+
+    jobs 是同时上传的文件数量, transfer 来自 get_transfer_config.
+    每上传成功一张图片就记录在上传日志中, 全部完成后再合并到 r2_waiting.json.
+    """
+    r2_waiting = get_r2_waiting()
+    missing = {pic_path for pic_path in r2_waiting if not os.path.exists(pic_path)}
+    if missing:
+        # 例如已被删除或替换的缩小版本, 不必上传
+        for pic_path in sorted(missing):
+            print(f"文件不存在, 从等待列表中删除: {pic_path}")
+        r2_waiting.difference_update(missing)
+        write_r2_waiting(r2_waiting)
+    tasks = {pic_path: partial(upload_pic, pic_path, bucket, transfer)
+             for pic_path in sorted(r2_waiting)}
+    upload_concurrently(tasks, jobs, lambda pic_path: append_journal(dict(pic=pic_path)))
+    compact_journal()
+
+
+def upload_assets(bucket, encoding:str="", jobs:int=1):
+    """上传 HTML/CSS 等文件到 Cloudflare R2
+
+    encoding 来自 get_content_encoding, 不为空时上传压缩后的文件.
+    jobs 是同时上传的文件数量.
+    checksum 是 MD5 (详见 file_checksum), 没有变化的文件只需 stat 一次 (详见 FileChecksumCache).
+    每上传成功一个文件就把它的 checksum 记录在上传日志中, 全部完成后再合并到 r2_files.json.
+    """
     r2_files = get_r2_files()
-    success = {}
+    checksum_cache.load(db.load_file_checksums())
+    checksums = {}
+    tasks = {}
     for obj_name in r2_files:
         filepath = Output_R2_Path.joinpath(obj_name)
-        checksum = file_checksum(filepath)
+        checksum = asset_checksum(filepath, encoding)
         if r2_files[obj_name] == checksum:
             continue
+        checksums[str(filepath)] = (obj_name, checksum)
+        tasks[str(filepath)] = partial(upload_asset, filepath, obj_name, bucket, encoding)
+    db.save_file_checksums(checksum_cache.used_items())
+    db.commit()
 
-        print(f"upload -> {filepath}")
-        if upload_file(str(filepath), obj_name, bucket):
-            success[obj_name] =checksum
-        else:
-            print(f"上传失败: {filepath}")
-    update_r2_files(success)
+    def on_success(filepath:str):
+        obj_name, checksum = checksums[filepath]
+        append_journal(dict(asset=obj_name, checksum=checksum))
+
+    upload_concurrently(tasks, jobs, on_success)
+    compact_journal()
 
 
 def delete_objects(obj_names:set[str], bucket):
     """返回删除失败的 obj name"""
     objects = [dict(Key=obj_name) for obj_name in obj_names]
     resp = bucket.delete_objects(Delete={"Objects": objects})
-    deleted = [obj["Key"] for obj in resp["Deleted"]]
+    deleted = [obj["Key"] for obj in resp.get("Deleted", [])]
     print_delete_result(obj_names, deleted)
+    return obj_names.difference(deleted)
 
 
 def delete_album(album_folder:str, bucket):
@@ -185,8 +599,54 @@ def print_delete_result(obj_names:set, deleted:list):
 
 
 def file_checksum(filepath:Path) -> str:
-    text = filepath.read_text()
-    return hashlib.sha1(text.encode()).hexdigest()
+    """MD5 (分块读取), 与 R2 对象的 ETag 相同 (分块上传及压缩上传的对象除外)."""
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(MB):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class FileChecksumCache:
+    """文件路径 -> (体积, 修改时间, inode, MD5).
+
+    体积, 修改时间及 inode 都没变的文件直接采用缓存的 MD5, 只需 stat 一次, 不必读取文件.
+    load 与 used_items 用于把缓存保存到数据库 (详见 upload_assets).
+    """
+    def __init__(self):
+        self.records = {}
+        self.used = {}
+
+    def load(self, items:dict[str, tuple]):
+        self.records.update(items)
+
+    def checksum(self, filepath:Path) -> str:
+        path = filepath.relative_to(CWD).as_posix()
+        stat = filepath.stat()
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        record = self.records.get(path)
+        if record is not None and tuple(record[:3]) == key:
+            md5 = record[3]
+        else:
+            md5 = file_checksum(filepath)
+        self.records[path] = self.used[path] = (*key, md5)
+        return md5
+
+    def used_items(self) -> dict[str, tuple]:
+        """本次运行用到的缓存, 已不存在的文件的旧缓存不保存."""
+        return dict(self.used)
+
+
+checksum_cache = FileChecksumCache()
+
+
+def asset_checksum(filepath:Path, encoding:str) -> str:
+    """压缩上传的文件的 checksum 带有 encoding 前缀,
+    因此修改 compress_assets 后全部文件都会重新上传."""
+    checksum = checksum_cache.checksum(filepath)
+    if should_compress(filepath, encoding):
+        return f"{encoding}:{checksum}"
+    return checksum
 
 
 def get_objects_by_prefix(prefix, bucket):
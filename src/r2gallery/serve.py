@@ -0,0 +1,319 @@
+import http.server
+import io
+import mimetypes
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+from . import db, model, util
+from .const import CWD, Gallery_Toml_Path, Templates_Path, Metadata, Thumbs, \
+    Album_Toml, Album_Index_List_HTML, Index_List_HTML, Index_HTML, Index2_HTML, \
+    Pic_HTML, Dot_HTML, Output_Local_Path
+from .model import Gallery, GalleryData, Album, Picture, Frontpage, FileStat
+
+"""
+r2g serve: 本地预览服务器.
+
+收到请求时才渲染网页 (不写入 output 文件夹), 渲染结果保存在内存中的 LRU 缓存里.
+网页采用 r2 版本 (parent_dir 为空), 因此网址与相册文件夹的结构一致:
+/{相册}/{图片}.html 是图片网页, /{相册}/{图片文件名} 直接读取相册文件夹里的原图,
+/{相册}/thumbs/... 是缩略图 (缺少缩略图时在内存中生成).
+其他文件 (例如 theme.css) 从 output_local 文件夹读取.
+
+每个请求都会检查 gallery.toml, templates 及相关相册的文件有无变化 (同一个文件夹
+在 Rescan_Interval 秒内只扫描一次), 有变化时重新读取, 因此修改 toml 或模板后刷新浏览器
+即可看到效果. 只有检查及重新读取时需要加锁, 读取文件, 渲染网页及生成缩略图都不加锁.
+"""
+
+Rescan_Interval = 1.0
+"""打开一个网页时浏览器会同时请求很多图片, 不必每个请求都重新扫描文件夹"""
+
+Page_Name_Pattern = re.compile(r"(index2?)(?:-(\d+))?\.html")
+"""相册索引页及图库首页的文件名, 详见 util.get_page_name"""
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存"""
+    def __init__(self, maxsize:int):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+
+class AlbumView:
+    """一个相册在预览时需要的全部数据 (相册内的文件有变化时重新生成)."""
+    def __init__(self, album_path:Path, gallery:Gallery):
+        self.files = scan_album(album_path)
+        self.checked = time.monotonic()
+        self.album = Album.loads(album_path.joinpath(Album_Toml))
+        self.album_data = self.album.to_data(album_path, gallery.bucket_url)
+
+        # 只包括已有 toml 的图片 (新图片需要先执行 r2g -update)
+        pics = [pic for pic in util.get_pic_files(album_path)
+                if util.get_pic_toml_path(pic) in self.files]
+        pics_sorted = util.sort_pics(pics, self.album, album_path)
+        self.pics = [pic for pic in pics_sorted if pic in self.files]
+        records = db.get_album_images(album_path.name)
+        self.pics_data = [
+            Picture.loads(util.get_pic_toml_path(pic)).to_data(
+                pic, util.get_deriv_data(records.get(pic.name), gallery))
+            for pic in self.pics
+        ]
+        self.index = {pic.file_id: i for i, pic in enumerate(self.pics_data)}
+
+
+def scan_album(album_path:Path) -> dict[Path, FileStat]:
+    """相册文件夹及其 metadata 文件夹的全部文件, 用于判断相册有无变化."""
+    files = util.scan_files(album_path)
+    files.update(util.scan_files(album_path.joinpath(Metadata)))
+    return files
+
+
+class PreviewSite:
+    """按需渲染网页, 并缓存渲染结果及缩略图.
+
+    AlbumView 生成后不再修改 (有变化时整个替换), 因此可以在锁外使用.
+    """
+    def __init__(self, gallery:Gallery, cache_size:int):
+        self.gallery = gallery
+        self.gallery_data = gallery.to_data()
+        self.gallery_mtime = Gallery_Toml_Path.stat().st_mtime_ns
+        self.templates = util.scan_files(Templates_Path)
+        self.templates_checked = time.monotonic()
+        self.albums: dict[str, AlbumView] = {}
+        self.pages = LRUCache(cache_size)
+        self.thumbs = LRUCache(cache_size)
+        self.lock = threading.Lock()
+
+    def get(self, url_path:str) -> tuple[bytes, str] | None:
+        """:return: (内容, Content-Type), 找不到时返回 None"""
+        parts = [part for part in url_path.split("/") if part]
+        if any(part.startswith(".") for part in parts):
+            return None
+        if not parts:
+            parts = [Index_HTML]
+
+        if len(parts) == 1 and Page_Name_Pattern.fullmatch(parts[0]):
+            gallery, gallery_data, albums = self.snapshot(None)
+            return self.gallery_page(gallery, gallery_data, albums, parts[0])
+
+        gallery, gallery_data, albums = self.snapshot(parts[0])
+        album = albums.get(parts[0])
+        if album is None:
+            return read_file(Output_Local_Path.joinpath(*parts))
+        if len(parts) == 1:
+            parts.append(Index_HTML)
+        if len(parts) == 2 and parts[1].endswith(Dot_HTML):
+            return self.album_page(gallery_data, album, parts[1])
+        if len(parts) == 3 and parts[1] == Thumbs:
+            return self.thumb(gallery, album, parts[0], parts[2])
+        return read_file(CWD.joinpath(*parts))
+
+    def snapshot(self, name:str|None) -> tuple[Gallery, GalleryData, dict[str, AlbumView]]:
+        """在锁内检查有无变化, 返回当前的 gallery 及相册 (name 为 None 时返回全部相册,
+        name 不是相册时返回空的 dict)."""
+        with self.lock:
+            self.refresh()
+            names = self.gallery.albums if name is None else [name]
+            albums = {name: self.get_album(name) for name in names
+                      if name in self.gallery.albums and CWD.joinpath(name).exists()}
+            return self.gallery, self.gallery_data, albums
+
+    def refresh(self):
+        """gallery.toml 或模板有变化时清除缓存的数据."""
+        mtime = Gallery_Toml_Path.stat().st_mtime_ns
+        if mtime != self.gallery_mtime:
+            self.gallery = Gallery.loads()
+            self.gallery_data = self.gallery.to_data()
+            self.gallery_mtime = mtime
+            self.albums.clear()
+        now = time.monotonic()
+        if now - self.templates_checked < Rescan_Interval:
+            return
+        self.templates_checked = now
+        templates = util.scan_files(Templates_Path)
+        if templates != self.templates:
+            util.clear_template_checksums()
+            self.templates = templates
+
+    def get_album(self, name:str) -> AlbumView:
+        album_path = CWD.joinpath(name)
+        album = self.albums.get(name)
+        if album is not None:
+            now = time.monotonic()
+            if now - album.checked < Rescan_Interval:
+                return album
+            if scan_album(album_path) == album.files:
+                album.checked = now
+                return album
+            for file in album.files:
+                model.toml_map.forget(file)
+        album = AlbumView(album_path, self.gallery)
+        # sort_pics 可能更新 db.images 里缓存的 ctime, 须立即提交, 以免锁住数据库
+        db.commit()
+        self.albums[name] = album
+        return album
+
+    def gallery_page(
+            self,
+            gallery:Gallery,
+            gallery_data:GalleryData,
+            albums:dict[str, AlbumView],
+            page_name:str
+    ):
+        known = {name: album.album_data for name, album in albums.items()}
+        pages = util.paginate(gallery.get_albumdata(known), gallery.albums_per_page)
+        single = gallery.frontpage == Frontpage.Single.name
+        tmpl_name, num, total = get_page(
+            page_name, gallery.index_html_name(), Index_List_HTML, pages, single)
+        if tmpl_name is None:
+            return None
+        data = dict(
+            output_type="r2",
+            gallery=gallery_data,
+            albums=pages[num-1],
+            page=util.get_page_data(Index_Names[tmpl_name == Index_List_HTML], num, total),
+        )
+        return self.render(page_name, tmpl_name, data)
+
+    def album_page(self, gallery_data:GalleryData, album:AlbumView, page_name:str):
+        pic_id = page_name.removesuffix(Dot_HTML)
+        if pic_id in album.index:
+            i = album.index[pic_id]
+            ids = list(album.index)
+            data = dict(
+                pic=album.pics_data[i],
+                album=album.album_data,
+                gallery=gallery_data,
+                parent_dir="",
+                prev_pic=ids[i-1],
+                next_pic=ids[(i+1) % len(ids)],
+            )
+            return self.render(f"{album.album_data.name}/{page_name}", Pic_HTML, data)
+
+        pages = util.paginate(album.pics_data, album.album.page_size)
+        single = album.album.frontpage == Frontpage.Single.name
+        tmpl_name, num, total = get_page(
+            page_name, album.album.index_html_name(), Album_Index_List_HTML, pages, single)
+        if tmpl_name is None:
+            return None
+        data = dict(
+            gallery=gallery_data,
+            album=album.album_data,
+            pictures=pages[num-1],
+            parent_dir="",
+            page=util.get_page_data(
+                Index_Names[tmpl_name == Album_Index_List_HTML], num, total),
+        )
+        return self.render(f"{album.album_data.name}/{page_name}", tmpl_name, data)
+
+    def render(self, url:str, tmpl_name:str, data:dict):
+        """渲染结果以 (网址, build key) 为 key 缓存, 数据或模板有变化时 key 也会变化."""
+        key = (url, util.build_key(tmpl_name, data))
+        page = self.pages.get(key)
+        if page is None:
+            tmpl = util.jinja_env.get_template(tmpl_name)
+            page = tmpl.render(data).encode("utf-8")
+            self.pages.put(key, page)
+        return page, "text/html; charset=utf-8"
+
+    def thumb(self, gallery:Gallery, album:AlbumView, album_name:str, thumb_name:str):
+        """优先读取 thumbs 文件夹里的缩略图, 没有则在内存中生成."""
+        thumb_path = CWD.joinpath(album_name, Thumbs, thumb_name)
+        if thumb_path.exists():
+            return read_file(thumb_path)
+        pic_id = Path(thumb_name).stem
+        if pic_id not in album.index:
+            return None
+        pic_path = album.pics[album.index[pic_id]]
+        stat = album.files[pic_path]
+        key = (pic_path, stat.mtime_ns)
+        thumb = self.thumbs.get(key)
+        if thumb is None:
+            info = util.probe_image(pic_path, stat)
+            buf = io.BytesIO()
+            util.create_thumb(pic_path, info, buf, gallery)
+            thumb = buf.getvalue()
+            self.thumbs.put(key, thumb)
+        return thumb, mimetypes.guess_type(thumb_name)[0] or "image/jpeg"
+
+
+Index_Names = (Index_HTML, Index2_HTML)
+"""Index_Names[是否列表页]"""
+
+
+def get_page(page_name:str, index_tmpl:str, list_tmpl:str, pages:list, single:bool):
+    """根据文件名找出模板及页码.
+
+    :return: (tmpl_name, num, total), 不存在的分页返回 (None, 0, 0)
+    """
+    match = Page_Name_Pattern.fullmatch(page_name)
+    if not match:
+        return None, 0, 0
+    num = int(match.group(2) or 1)
+    if match.group(1) == "index":
+        tmpl_name, total = index_tmpl, (1 if single else len(pages))
+    else:
+        tmpl_name, total = list_tmpl, len(pages)
+    if num < 1 or num > total:
+        return None, 0, 0
+    return tmpl_name, num, total
+
+
+def read_file(file:Path):
+    if not file.is_file():
+        return None
+    content_type = mimetypes.guess_type(file.name)[0] or "application/octet-stream"
+    return file.read_bytes(), content_type
+
+
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    site: PreviewSite = None
+
+    def do_GET(self):
+        url_path = unquote(urlsplit(self.path).path)
+        try:
+            result = self.site.get(url_path)
+        except Exception as err:
+            # 编辑中的 toml 可能暂时有格式错误, 不应结束预览
+            print(f"Error: {err}", file=sys.stderr)
+            self.send_error(500, str(err))
+            return
+        if result is None:
+            self.send_error(404)
+            return
+        body, content_type = result
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_gallery(gallery:Gallery, host:str, port:int, cache_size:int):
+    util.setup_jinja_cache()
+    model.markdown_cache.load(db.load_markdown())
+    PreviewHandler.site = PreviewSite(gallery, cache_size)
+    server = http.server.ThreadingHTTPServer((host, port), PreviewHandler)
+    print(f"预览网址: http://{host}:{port}/ (按 Ctrl+C 结束)")
+    with server:
+        server.serve_forever()
@@ -1,14 +1,26 @@
+import hashlib
+import io
+import math
 import os
+import re
 import shutil
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from contextlib import nullcontext
+from functools import partial
+from typing import Iterable
 
 import arrow
 import jinja2
+import jinja2.meta
+from markupsafe import escape
 from PIL import Image, ImageOps
 
-from . import model, r2
+from . import model, r2, db
 from .const import *
-from .model import Gallery, Album, Picture, PictureData, AlbumData, SortBy, GalleryData
+from .model import Gallery, Album, Picture, PictureData, AlbumData, SortBy, GalleryData, \
+    ImageInfo, ImageFormat, PageData, Frontpage, FileStat
 
 """
 【关于返回值】
@@ -21,6 +33,13 @@ jinja_env = jinja2.Environment(
     loader=loader, autoescape=jinja2.select_autoescape()
 )
 
+Package_Templates_Path = Path(__file__).parent.joinpath(Templates)
+
+# TOML 文件总是采用本软件自带的模板 (而不是图库 templates 文件夹里的模板),
+# 因为旧图库的模板是在 init 时复制的, 缺少后来新增的项目,
+# 用旧模板重新生成 toml 文件会把用户填写的新项目 (例如 upload_jobs) 删除.
+toml_env = jinja2.Environment(loader=jinja2.FileSystemLoader(Package_Templates_Path))
+
 # tmplfile 可能没用
 # 将templates 文件夹内除了 tmplfile 之外的全部文件都复制到 output 文件夹
 _tmplfile = dict(
@@ -38,24 +57,248 @@ _tmplfile = dict(
 )
 
 
+def setup_jinja_cache():
+    """模板编译后的 bytecode 保存在 jinja_cache 文件夹, 下次运行时
+    没有修改过的模板不需要重新解析和编译. 然后预先加载全部网页模板,
+    以免多个渲染线程同时编译同一个模板.
+
+    在渲染网页前调用, 不在 import 时执行, 以免 `r2g init` 时图库文件夹不是空的.
+    """
+    if jinja_env.bytecode_cache is None:
+        Jinja_Cache_Path.mkdir(exist_ok=True)
+        jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(Jinja_Cache_Path)
+    for name in jinja_env.list_templates(extensions=["html", "js"]):
+        jinja_env.get_template(name)
+
+
 def render_write(tmpl_name:str, output_path:Path, data:dict):
     tmpl = jinja_env.get_template(tmpl_name)
-    rendered = tmpl.render(data)
+    write_rendered(output_path, tmpl.render(data))
+
+
+def write_rendered(output_path:Path, rendered:str):
+    """内容与现有文件相同时不写入, 以免改变文件的修改时间.
+    output_r2 里的网页先压缩空白 (详见 minify).
+    """
+    if _minify_r2 and Output_R2_Path in output_path.parents:
+        minified = minify(rendered, output_path.suffix)
+        count_minify(len(rendered.encode("utf-8")), len(minified.encode("utf-8")))
+        rendered = minified
+    content = rendered.encode("utf-8")
+    if is_same_content(output_path, content):
+        count_write("unchanged")
+        return
     print(f"render and write {output_path}")
-    output_path.write_text(rendered, encoding="utf-8")
+    output_path.write_bytes(content)
+    count_write("written")
+
+
+def is_same_content(file:Path, content:bytes) -> bool:
+    """先比较体积, 体积相同时才读取文件."""
+    try:
+        if file.stat().st_size != len(content):
+            return False
+        return file.read_bytes() == content
+    except FileNotFoundError:
+        return False
+
+
+_write_counts = dict(written=0, unchanged=0, raw_bytes=0, minified_bytes=0)
+_write_counts_lock = threading.Lock()
+"""渲染网页时会在多个线程中写文件"""
+
+
+def count_write(name:str):
+    with _write_counts_lock:
+        _write_counts[name] += 1
+
+
+def count_minify(raw_bytes:int, minified_bytes:int):
+    with _write_counts_lock:
+        _write_counts["raw_bytes"] += raw_bytes
+        _write_counts["minified_bytes"] += minified_bytes
+
+
+def reset_write_counts():
+    with _write_counts_lock:
+        for name in _write_counts:
+            _write_counts[name] = 0
+
+
+def print_write_counts():
+    written, unchanged = _write_counts["written"], _write_counts["unchanged"]
+    print(f"写入 {written} 个文件, 跳过 {unchanged} 个内容没有变化的文件.")
+    raw, minified = _write_counts["raw_bytes"], _write_counts["minified_bytes"]
+    if raw > 0:
+        saved = raw - minified
+        print(f"output_r2 压缩空白: {raw} -> {minified} bytes "
+              f"(节省 {saved} bytes, {saved*100/raw:.1f}%)")
+
+
+_minify_r2 = False
+"""是否压缩 output_r2 里的网页, 由 render_all 根据 gallery.minify_r2 设置."""
+
+Preformatted_Pattern = re.compile(r"<(pre|textarea)\b.*?</\1\s*>", re.S | re.I)
+HTML_Comment_Pattern = re.compile(r"<!--(?!\[if).*?-->", re.S)
+Line_Break_Pattern = re.compile(r"[ \t\r\f\v]*\n\s*")
+Spaces_Pattern = re.compile(r"[ \t]+")
+
+
+def minify(text:str, suffix:str) -> str:
+    """压缩 HTML/JS 的空白: 删除每行的缩进及空行, 连续的空格合并为一个,
+    HTML 还删除注释. <pre> 与 <textarea> 的内容保持不变.
+
+    保留换行 (不合并行), 因此不会改变 JS 的语义, 也不会改变 HTML 的显示效果
+    (在 HTML 中, 连续的空白与一个换行的效果相同).
+    """
+    if suffix == Dot_HTML:
+        parts = []
+        pos = 0
+        for match in Preformatted_Pattern.finditer(text):
+            parts.append(minify_text(text[pos:match.start()], True))
+            parts.append(match.group())
+            pos = match.end()
+        parts.append(minify_text(text[pos:], True))
+        return "".join(parts).strip()
+    return minify_text(text, False).strip()
+
+
+def minify_text(text:str, is_html:bool) -> str:
+    if is_html:
+        text = HTML_Comment_Pattern.sub("", text)
+    text = Line_Break_Pattern.sub("\n", text)
+    return Spaces_Pattern.sub(" ", text)
+
+
+def render_output(tmpl_name:str, output_path:Path, data:dict, force=False):
+    """渲染 output_local/output_web/output_r2 里的网页.
+
+    输出文件的输入 (模板及其引用的模板, 以及 data) 没有变化时跳过渲染,
+    输入的 checksum 记录在 db.outputs (build manifest) 中.
+    force 为 True 时不管有无变化都重新渲染.
+    """
+    key = build_key(tmpl_name, data)
+    if not force and is_output_fresh(output_path, key):
+        return
+    render_write(tmpl_name, output_path, data)
+    db.set_output_key(output_obj_name(output_path), key)
+
+
+Parent_Dir_Placeholder = "\x00parent_dir\x00"
+"""TOML 字符串不允许出现控制字符, 因此占位符不会与网页内容冲突."""
+
+
+def render_variants(
+        tmpl_name:str, outputs:dict[Path, str], data:dict, force=False):
+    """同一网页的 r2/local/web 版本只有 parent_dir 不同, 因此只渲染一次
+    (parent_dir 采用占位符), 再替换占位符得到各个版本.
+
+    注意: 模板中的 parent_dir 只能直接输出 (例如 {{parent_dir}}),
+    不可用于判断或传给过滤器.
+    outputs: dict(输出文件: parent_dir), 其中 r2 版本的 parent_dir 是空字符串.
+    """
+    stale = {}
+    for output_path, parent_dir in outputs.items():
+        key = build_key(tmpl_name, dict(data, parent_dir=parent_dir))
+        if force or not is_output_fresh(output_path, key):
+            stale[output_path] = (parent_dir, key)
+    if not stale:
+        return
+
+    tmpl = jinja_env.get_template(tmpl_name)
+    rendered = tmpl.render(dict(data, parent_dir=Parent_Dir_Placeholder))
+    autoescape = jinja_env.autoescape
+    if callable(autoescape):
+        autoescape = autoescape(tmpl_name)
+    for output_path, (parent_dir, key) in stale.items():
+        if autoescape:
+            parent_dir = str(escape(parent_dir))
+        write_rendered(output_path, rendered.replace(Parent_Dir_Placeholder, parent_dir))
+        db.set_output_key(output_obj_name(output_path), key)
+
+
+def output_obj_name(output_path:Path) -> str:
+    return output_path.relative_to(CWD).as_posix()
+
+
+def is_output_fresh(output_path:Path, key:str) -> bool:
+    """输出文件存在, 并且上次渲染时的 build key 与 key 相同."""
+    return output_path.exists() and db.get_output_key(output_obj_name(output_path)) == key
+
+
+def get_parent_dir(target:str, album_name:str, bucket_url:str) -> str:
+    """相册内的网页引用图片, CSS 等文件时使用的前缀."""
+    match target:
+        case "local":
+            return f"../../{album_name}/"
+        case "web":
+            return f"{bucket_url}{album_name}/"
+        case _:
+            return ""
+
+
+def get_targets(text:str|None) -> (list[str], str):
+    """text 是以逗号分隔的 target (例如 "r2,local"), 为空时返回全部 target."""
+    if not text:
+        return list(Output_Paths), None
+    targets = [t.strip().lower() for t in text.split(",") if t.strip()]
+    for target in targets:
+        if target not in Output_Paths:
+            return [], f"未知的 target: {target} (可选: {', '.join(Output_Paths)})"
+    return [t for t in Output_Paths if t in targets], None
+
+
+def build_key(tmpl_name:str, data:dict) -> str:
+    """一个输出文件的全部输入的 checksum.
+
+    data 里只有 str/int/list/dict 及 dataclass, 因此 repr 是确定的.
+    """
+    text = template_checksum(tmpl_name) + repr(data)
+    if _minify_r2:
+        # 开启/关闭 minify_r2 后需要重新渲染
+        text += "minify_r2"
+    return model.text_checksum(text)
+
+
+_template_checksums = {}
+
+
+def template_checksum(tmpl_name:str) -> str:
+    """模板及其引用 (extends/include/import) 的全部模板的 checksum,
+    修改 templates 文件夹内的模板后, 用到该模板的网页都会重新渲染."""
+    if tmpl_name in _template_checksums:
+        return _template_checksums[tmpl_name]
+    source, _, _ = loader.get_source(jinja_env, tmpl_name)
+    names = jinja2.meta.find_referenced_templates(jinja_env.parse(source))
+    text = source + "".join(template_checksum(name) for name in sorted(names))
+    checksum = model.text_checksum(text)
+    _template_checksums[tmpl_name] = checksum
+    return checksum
+
+
+def clear_template_checksums():
+    """修改模板后 (例如 r2g watch 运行期间) 需要重新计算."""
+    _template_checksums.clear()
+
+
+def render_toml(tmpl_name:str, output_path:Path, data:dict):
+    tmpl = toml_env.get_template(tmpl_name)
+    write_rendered(output_path, tmpl.render(data))
 
 
 def render_gallery_toml(gallery:Gallery):
-    render_write(Gallery_Toml, Gallery_Toml_Path, dict(data=gallery))
+    render_toml(Gallery_Toml, Gallery_Toml_Path, dict(data=gallery))
 
 
 def render_album_toml(album:Album, name:str):
     toml_path = CWD.joinpath(name, Album_Toml)
-    render_write(Album_Toml, toml_path, dict(data=album))
+    render_toml(Album_Toml, toml_path, dict(data=album))
+    model.toml_map.put(toml_path, album)
 
 
 def render_picture_toml(toml_path:Path, pic:Picture):
-    render_write(Picture_Toml, toml_path, dict(data=pic))
+    render_toml(Picture_Toml, toml_path, dict(data=pic))
+    model.toml_map.put(toml_path, pic)
 
 
 def folder_not_empty(folder):
@@ -99,8 +342,7 @@ def is_gallery_folder():
 
 
 def copy_templates():
-    src_folder = Path(__file__).parent.joinpath(Templates)
-    shutil.copytree(src_folder, Templates_Path)
+    shutil.copytree(Package_Templates_Path, Templates_Path)
 
 
 def create_album(name:str, gallery:Gallery):
@@ -115,7 +357,9 @@ def create_album(name:str, gallery:Gallery):
     album_toml_path = album_path.joinpath(Album_Toml)
     metadata_path = album_path.joinpath(Metadata)
     thumbs_path = album_path.joinpath(Thumbs)
+    derivs_path = album_path.joinpath(Derivs)
     thumbs_path.mkdir()
+    derivs_path.mkdir()
     metadata_path.mkdir()
     album = Album.default(name)
     render_album_toml(album, name)
@@ -126,101 +370,191 @@ def create_album(name:str, gallery:Gallery):
     return None
 
 
-def render_all(albums_pics:dict, gallery:Gallery, force=False):
-    update_gallery = render_all_albums(albums_pics, gallery, force)
-    if not force:
-        force = update_gallery
-    render_gallery_index(gallery, force)
-    r2.add_to_r2_files([Index_HTML])
-
+def render_all(
+        albums_pics:dict,
+        gallery:Gallery,
+        force=False,
+        jobs:int=1,
+        targets:list[str]=None
+):
+    """只渲染有变化的网页 (详见 render_output), force 为 True 时全部重新渲染.
+
+    jobs 是并行渲染网页的线程数.
+    targets 是需要生成的输出目标 (详见 const.Output_Paths), 默认全部生成.
+    """
+    global _minify_r2
+    _minify_r2 = gallery.minify_r2
+    targets = targets or list(Output_Paths)
+    reset_write_counts()
+    setup_jinja_cache()
+    model.markdown_cache.load(db.load_markdown())
+    albums_data = render_all_albums(albums_pics, gallery, force, jobs, targets)
+    page_names = render_gallery_index(gallery, force, albums_data, targets)
+    if "r2" in targets:
+        r2.add_to_r2_files(page_names)
+    db.save_markdown(model.markdown_cache.used_items())
+    db.commit()
+    print_write_counts()
+
+
+def render_gallery_index(
+        gallery:Gallery,
+        force:bool,
+        albums_data:dict[str, AlbumData]=None,
+        targets:list[str]=None
+) -> list[str]:
+    """albums_data 是 render_all_albums 已生成的 AlbumData,
+    全部首页 (local/web/r2 × frontpage/list × 分页) 共用同一份 gallery 及相册数据.
+
+    首页按 gallery.albums_per_page 分页, 每页只包含该页的相册,
+    因此修改一个相册只会重新渲染该相册所在的那一页.
+    :return: 首页的文件名列表 (index.html, index2.html, index-2.html ...)
+    """
+    checksum = gallery.make_checksum()
+    if gallery.checksum != checksum:
+        gallery.checksum = checksum
+        render_gallery_toml(gallery)
 
-def render_gallery_index(gallery:Gallery, force:bool):
-    local_output_path  = Output_Local_Path.joinpath(Index_HTML)
-    local_output_path2 = Output_Local_Path.joinpath(Index2_HTML)
-    web_output_path    = Output_Web_Path.joinpath(Index_HTML)
-    web_output_path2   = Output_Web_Path.joinpath(Index2_HTML)
-    r2_output_path     = Output_R2_Path.joinpath(Index_HTML)
-    r2_output_path2    = Output_R2_Path.joinpath(Index2_HTML)
-
-    force = render_index_html(
-        "local", gallery.index_html_name(), local_output_path, gallery, force)
-    render_index_html(
-        "web", gallery.index_html_name(), web_output_path, gallery, force)
-    render_index_html(
-        "r2", gallery.index_html_name(), r2_output_path, gallery, force)
-    render_index_html(
-        "local", Index_List_HTML, local_output_path2, gallery, force)
-    render_index_html(
-        "web", Index_List_HTML, web_output_path2, gallery, force)
-    render_index_html(
-        "r2", Index_List_HTML, r2_output_path2, gallery, force)
-
-
-def update_all_albums(albums_pics:dict, gallery:Gallery):
-    """返回 True 表示有错, 返回 False 表示无错."""
-    for album, pics in albums_pics.items():
-        if update_album(pics, Path(album), gallery):
-            return True
+    targets = targets or list(Output_Paths)
+    gallery_data = gallery.to_data()
+    pages = paginate(gallery.get_albumdata(albums_data), gallery.albums_per_page)
+    # Single 只展示图库简介, 不需要分页
+    index_total = 1 if gallery.frontpage == Frontpage.Single.name else len(pages)
+    page_names = []
+    for tmpl_name, filename, total in [
+        (gallery.index_html_name(), Index_HTML, index_total),
+        (Index_List_HTML, Index2_HTML, len(pages)),
+    ]:
+        for num in range(1, total+1):
+            data = dict(gallery=gallery_data, albums=pages[num-1],
+                        page=get_page_data(filename, num, total))
+            page_name = get_page_name(filename, num)
+            for output_type in targets:
+                output_path = Output_Paths[output_type].joinpath(page_name)
+                render_index_html(output_type, tmpl_name, output_path, data, force)
+            page_names.append(page_name)
+        output_folders = {target: Output_Paths[target] for target in targets}
+        delete_stale_pages(output_folders, filename, total)
+    return page_names
+
+
+def update_all_albums(albums_pics:dict, gallery:Gallery, jobs:int=1):
+    """返回 True 表示有错, 返回 False 表示无错.
+
+    jobs 是并行处理图片的进程数, 小于等于 1 时不使用进程池.
+    """
+    with get_executor(jobs) as executor:
+        for album, pics in albums_pics.items():
+            err = update_album(pics, Path(album), gallery, executor, jobs)
+            db.commit()
+            if err:
+                return True
     return False
 
 
+def get_jobs(jobs:int|None) -> int:
+    """jobs 为空或小于 1 时, 采用 CPU 核心数."""
+    if not jobs or jobs < 1:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def get_executor(jobs:int):
+    """返回进程池, jobs 小于等于 1 时返回一个什么都不做的 context manager."""
+    if jobs <= 1:
+        return nullcontext()
+    return ProcessPoolExecutor(max_workers=jobs)
+
+
+def pool_map(executor, jobs:int, func, items:list, *more_items) -> list:
+    """相当于 list(map(func, items, *more_items)), 有 executor 时在进程池中执行.
+
+    jobs 是 executor 的进程数 (详见 get_executor), 用来决定每次分给一个进程的数量.
+    返回结果的顺序与 items 的顺序一致.
+    """
+    if executor is None or len(items) <= 1:
+        return list(map(func, items, *more_items))
+    chunksize = max(1, len(items) // (jobs * 4))
+    return list(executor.map(func, items, *more_items, chunksize=chunksize))
+
+
 def render_all_albums(
         albums_pics:dict,
         gallery:Gallery,
-        force=False
-) -> bool:
-    """:return: True 表示需要重新渲染 gallery 首页."""
-    update_gallery = False
-    for album_folder, pics in albums_pics.items():
-        album_path = Path(album_folder)
-        album = Album.loads(album_path.joinpath(Album_Toml))
-        album_data = album.to_data(album_path, gallery.bucket_url)
-        pics_sorted = sort_pics(pics, album, album_path)
-
-        local_album_folder = Output_Local_Path.joinpath(album_data.name)
-        local_album_folder.mkdir(exist_ok=True)
-        web_album_folder = Output_Web_Path.joinpath(album_data.name)
-        web_album_folder.mkdir(exist_ok=True)
-        r2_album_folder = Output_R2_Path.joinpath(album_data.name)
-        r2_album_folder.mkdir(exist_ok=True)
-
-        # 渲染相册内的图片
-        pics_data_list = render_album_pics(
-            pics_sorted,
-            local_album_folder,
-            web_album_folder,
-            r2_album_folder,
-            album_data,
-            gallery.to_data()
-        )
-
-        # 渲染相册索引页
-        update_gallery = render_album_index_html(
-            local_album_folder,
-            web_album_folder,
-            r2_album_folder,
-            gallery,
-            album,
-            album_data,
-            pics_data_list,
-            force=force,
-        )
-
-        # 添加待上传的文件 到 r2_files.json
-        obj_names = [pic.r2_html for pic in pics_data_list]
-        pics_js_name = f"{album_data.name}/{Pics_Id_List_JS}"
-        obj_names.extend([album_data.r2_html, pics_js_name])
-        r2.add_to_r2_files(obj_names)
-
-    return update_gallery
-
-
-def sort_pics(pics_paths:list[Path], album:Album, album_path:Path) -> list[Path]:
+        force=False,
+        jobs:int=1,
+        targets:list[str]=None
+) -> dict[str, AlbumData]:
+    """全部相册的图片网页都提交到同一个线程池 (jobs 个线程) 中并行渲染,
+    每个相册的索引页等该相册的全部图片网页渲染完成后再渲染.
+
+    :return: dict(相册名: AlbumData)
+    """
+    albums_data = {}
+    albums = []
+    gallery_data = gallery.to_data()
+    db.load_output_keys()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for album_folder, pics in albums_pics.items():
+            album_path = Path(album_folder)
+            album = Album.loads(album_path.joinpath(Album_Toml))
+            album_data = album.to_data(album_path, gallery.bucket_url)
+            albums_data[album_data.name] = album_data
+            pics_sorted = sort_pics(pics, album, album_path)
+            records = db.get_album_images(album_path.name)
+            derivs = {pic: get_deriv_data(records.get(pic.name), gallery)
+                      for pic in pics_sorted}
+
+            album_folders = {
+                target: Output_Paths[target].joinpath(album_data.name)
+                for target in targets or list(Output_Paths)
+            }
+            for folder in album_folders.values():
+                folder.mkdir(exist_ok=True)
+
+            # 渲染相册内的图片
+            pics_futures = render_album_pics(
+                pics_sorted,
+                album_folders,
+                album_data,
+                gallery_data,
+                derivs,
+                executor,
+                force=force,
+            )
+            albums.append((album, album_data, album_folders, pics_futures))
+
+        for album, album_data, album_folders, pics_futures in albums:
+            pics_data_list = [future.result() for future in pics_futures]
+
+            # 渲染相册索引页
+            page_names = render_album_index_html(
+                album_folders,
+                gallery_data,
+                album,
+                album_data,
+                pics_data_list,
+                force=force,
+            )
+
+            # 添加待上传的文件 到 r2_files.json
+            if "r2" not in album_folders:
+                continue
+            obj_names = [pic.r2_html for pic in pics_data_list]
+            pics_js_name = f"{album_data.name}/{Pics_Id_List_JS}"
+            obj_names.extend(f"{album_data.name}/{name}" for name in page_names)
+            obj_names.append(pics_js_name)
+            r2.add_to_r2_files(obj_names)
+
+    return albums_data
+
+
+def sort_pics(pics_paths:Iterable[Path], album:Album, album_path:Path) -> list[Path]:
     sort_by = SortBy[album.sort_by]
     if sort_by is SortBy.List:
         return [album_path.joinpath(filename) for filename in album.pictures]
 
-    pairs = pics_with_ctime(pics_paths)
+    pairs = pics_with_ctime(pics_paths, album_path)
     if sort_by is SortBy.CTimeDesc:
         pairs = sorted(pairs, key=lambda pair: pair[1], reverse=True)
     else:
@@ -229,18 +563,34 @@ def sort_pics(pics_paths:list[Path], album:Album, album_path:Path) -> list[Path]
     return [pair[0] for pair in pairs]
 
 
-def pics_with_ctime(pics_paths:list):
-    """:return: (pic_path, ctime)"""
+def pics_with_ctime(pics_paths:Iterable[Path], album_path:Path):
+    """:return: (pic_path, ctime)
+
+    toml 的修改时间没变时, 直接采用 db.images 里缓存的 ctime.
+    toml 的修改时间来自扫描 metadata 文件夹 (一次扫描, 不逐个 stat).
+    """
+    album = album_path.name
+    records = db.get_album_images(album)
+    tomls = scan_files(album_path.joinpath(Metadata))
     pairs = []
     for pic_path in pics_paths:
-        pic = Picture.loads(get_pic_toml_path(pic_path))
-        pairs.append((pic_path, pic.ctime))
+        toml_path = get_pic_toml_path(pic_path)
+        toml_mtime_ns = tomls[toml_path].mtime_ns
+        record = records.get(pic_path.name)
+        if record and record["toml_mtime_ns"] == toml_mtime_ns:
+            ctime = record["ctime"]
+        else:
+            ctime = Picture.loads(toml_path).ctime
+            db.set_ctime(album, pic_path.name, toml_mtime_ns, ctime)
+        pairs.append((pic_path, ctime))
     return pairs
 
 
-def resize_all_albums_pics(albums_pics:dict, gallery:Gallery):
-    for pics in albums_pics.values():
-        resize_oversize_pics(pics, gallery)
+def resize_all_albums_pics(albums_pics:dict, gallery:Gallery, jobs:int=1):
+    with get_executor(jobs) as executor:
+        for album, pics in albums_pics.items():
+            resize_oversize_pics(pics, Path(album), gallery, executor, jobs)
+            db.commit()
 
 
 def check_all_albums_cover(albums_pics:dict):
@@ -293,7 +643,7 @@ def check_all_bad_names(albums_pics:dict):
         err = "请修改以下文件名, \n" \
               "文件名只能使用 0-9, a-z, A-Z, _(下划线), -(短横线), .(点)\n" \
               "不能使用空格，请用下划线或短横线代替空格。\n" \
-              "并且不可使用 'index' 作为文件名。\n"
+              "并且不可使用 'index', 'index2', 'index-2' 之类的文件名 (相册索引页)。\n"
         print_bad_names(albums, err)
 
     return len(albums)
@@ -324,11 +674,25 @@ def get_all_albums_pictures(gallery:Gallery):
     return albums_pics
 
 
-def get_pic_files(album_path:Path):
-    """获取指定相册内全部图片的 Path"""
-    files = album_path.glob("*.*")
-    pics = [pic for pic in files if pic.is_file() and pic.name != Album_Toml]
-    return pics
+def get_pic_files(album_path:Path) -> dict[Path, FileStat]:
+    """获取指定相册内全部图片的 Path 及其体积, 修改时间 (相册快照).
+
+    只扫描一次文件夹, 之后的 update/render 都使用这个快照, 不再逐个 stat.
+    """
+    files = scan_files(album_path)
+    return {pic: stat for pic, stat in files.items()
+            if "." in pic.name and pic.name != Album_Toml}
+
+
+def scan_files(folder:Path) -> dict[Path, FileStat]:
+    """用 os.scandir 扫描文件夹 (不含子文件夹), 获取全部文件的体积及修改时间."""
+    files = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                files[Path(entry.path)] = FileStat(stat.st_size, stat.st_mtime_ns)
+    return files
 
 
 def get_all_albums(gallery:Gallery):
@@ -343,31 +707,127 @@ def get_all_albums(gallery:Gallery):
     return albums
 
 
-def update_album(pics:list, album_path:Path, gallery:Gallery) -> bool:
-    """返回 True 表示有错, 返回 False 表示无错."""
-    oversize_pics = get_oversize_pics(pics, gallery)
+def update_album(
+        pics:dict[Path, FileStat],
+        album_path:Path,
+        gallery:Gallery,
+        executor=None,
+        jobs:int=1
+) -> bool:
+    """返回 True 表示有错, 返回 False 表示无错.
+
+    每张图片只读取一次文件头 (probe), 得到的 ImageInfo 供检查体积,
+    生成 toml 及缩略图共用, 并且记录在 db.images 中, 下次 update 时
+    体积与修改时间都没变的图片不需要再打开. 读取文件头, 生成缩略图等
+    耗时的工作在 executor 中并行执行, 而写入 toml, album.toml,
+    r2_waiting.json 则在当前进程中按顺序执行.
+    """
+    records = db.get_album_images(album_path.name)
+    infos = probe_images(pics, records, executor, jobs)
+    tomls = scan_files(album_path.joinpath(Metadata))
+    oversize_pics = get_oversize_pics(infos, gallery)
     if oversize_pics:
         print_oversize_pics(oversize_pics)
         return True
 
-    new_pics = []
-    new_files_set = set()
-    for pic_path in pics:
-        img = open_image(pic_path)
-        if img is None:
+    # 没有 toml 文件的图片就是新图片,
+    # 新图片以及内容有变化的图片 (checksum 与生成缩略图时不同) 需要生成缩略图,
+    # 图片内容或 gallery 设定有变化时需要重新生成缩小版本 (响应式图片).
+    new_pics_set = set()
+    thumb_pics_set = set()
+    deriv_pics_set = set()
+    for pic_path, info in infos.items():
+        if info is None:
             print(f"Not Image: {pic_path.name}")
-        else:
-            if create_pic_toml_if_not_exists(img, pic_path):
-                new_pics.append(pic_path.name)
-                thumb_path = create_thumb_if_not_exists(img, pic_path, album_path, gallery)
-                new_files_set.add(str(thumb_path))
-                new_files_set.add(str(pic_path))
+            continue
+        record = records[pic_path.name]
+        if record["derivs"] != gallery.deriv_signature(info):
+            deriv_pics_set.add(pic_path)
+        if get_pic_toml_path(pic_path) not in tomls:
+            new_pics_set.add(pic_path)
+            thumb_pics_set.add(pic_path)
+            continue
+        thumb = record["thumb"]
+        if thumb == info.checksum:
+            continue
+        if not thumb and get_thumb_path(pic_path, album_path, gallery).exists():
+            # 在建立 db.images 之前已生成的缩略图
+            db.set_thumb(album_path.name, pic_path.name, info.checksum)
+            continue
+        thumb_pics_set.add(pic_path)
+
+    pics = [pic for pic in infos if pic in thumb_pics_set or pic in deriv_pics_set]
+    pics_infos = [infos[pic] for pic in pics]
+    need_thumbs = [pic in thumb_pics_set for pic in pics]
+    need_derivs = [pic in deriv_pics_set for pic in pics]
+    album_derivs = get_album_derivs(album_path.joinpath(Derivs)) if deriv_pics_set else {}
+    old_derivs = [album_derivs.get(pic.stem.lower(), []) for pic in pics]
+    process = partial(process_pic, album_path=album_path, gallery=gallery)
+    results = pool_map(
+        executor, jobs, process, pics, pics_infos, need_thumbs, need_derivs, old_derivs)
 
-    r2.add_pics_to_r2_waiting(new_files_set)
+    new_pics = []
+    new_files_set = set()
+    removed_files_set = set()
+    for pic_path, info, (thumb_path, deriv_paths, old_derivs) in \
+            zip(pics, pics_infos, results):
+        if pic_path in new_pics_set:
+            create_pic_toml(pic_path, info.datetime or model.now())
+            new_pics.append(pic_path.name)
+        if thumb_path is not None:
+            print(f"Create thumbnail {thumb_path}")
+            db.set_thumb(album_path.name, pic_path.name, info.checksum)
+            new_files_set.add(str(thumb_path))
+            new_files_set.add(str(pic_path))
+        if pic_path in deriv_pics_set:
+            for deriv_path in deriv_paths:
+                print(f"Create derivative {deriv_path}")
+                new_files_set.add(str(deriv_path))
+            removed_files_set.update(
+                str(path) for path in old_derivs if path not in deriv_paths)
+            db.set_derivs(album_path.name, pic_path.name, gallery.deriv_signature(info))
+
+    remove_replaced_derivs(removed_files_set)
+    r2.add_pics_to_r2_waiting(new_files_set, removed_files_set)
     update_album_pictures(new_pics, album_path)
     return False
 
 
+def process_pic(
+        pic_path:Path,
+        info:ImageInfo,
+        need_thumb:bool,
+        need_derivs:bool,
+        old_derivs:list[Path],
+        album_path:Path,
+        gallery:Gallery
+) -> tuple[Path|None, list[Path], list[Path]]:
+    """为一张图片生成缩略图及缩小版本. (在子进程中执行)
+
+    old_derivs 是该图片原有的缩小版本 (详见 get_album_derivs).
+    :return: (thumb_path|None, deriv_paths, 已删除的旧缩小版本)
+    """
+    thumb_path = None
+    deriv_paths = []
+    if need_thumb:
+        thumb_path = create_thumb_if_not_exists(pic_path, info, album_path, gallery)
+    if need_derivs:
+        deriv_paths = create_derivatives(pic_path, info, old_derivs, album_path, gallery)
+    else:
+        old_derivs = []
+    return thumb_path, deriv_paths, old_derivs
+
+
+def remove_replaced_derivs(removed_files:set[str]):
+    """已删除的旧缩小版本: 尚未上传的从 r2_waiting 中删除 (详见 add_pics_to_r2_waiting),
+    已上传的记录在 r2_deleting.json, 执行 `r2g upload` 时从云端删除.
+    """
+    r2_waiting = r2.get_r2_waiting()
+    uploaded = [path for path in removed_files if path not in r2_waiting]
+    if uploaded:
+        r2.add_to_r2_deleting("/".join(Path(path).parts[-3:]) for path in uploaded)
+
+
 def update_album_pictures(new_pics:list[str], album_path:Path):
     """添加图片到相册. TODO: 删除图片."""
     if not new_pics:
@@ -402,25 +862,114 @@ def get_double_names(pics:list) -> list[str]:
 
 def get_bad_pic_names(files:list[Path]) -> list[str]:
     """找出相册内不符合要求的图片文件名"""
-    bad_id_list = ["index"]
     bad_names = []
     for file in files:
-        if file.stem.lower() in bad_id_list:
+        if model.Index_Page_Pattern.fullmatch(file.stem.lower()):
             bad_names.append(file.name)
         if model.check_filename(file.name):
             bad_names.append(file.name)
     return bad_names
 
 
-def resize_oversize_pics(pics:list, gallery:Gallery):
-    oversize_pics = get_oversize_pics(pics, gallery)
-    for pic in oversize_pics:
-        img = open_image(pic)
+def resize_oversize_pics(
+        pics:dict[Path, FileStat],
+        album_path:Path,
+        gallery:Gallery,
+        executor=None,
+        jobs:int=1
+):
+    records = db.get_album_images(album_path.name)
+    oversize_pics = get_oversize_pics(probe_images(pics, records), gallery)
+    resize = partial(resize_pic, gallery=gallery)
+    for pic_path, passes in pool_map(executor, jobs, resize, oversize_pics):
+        print(f"Resize to {pic_path} (encoded {passes} times)")
+
+
+def resize_pic(pic:Path, gallery:Gallery) -> tuple[Path, int]:
+    """缩小一张图片, 使其宽, 高, 体积都不超过上限. (在子进程中执行)
+
+    :return: (pic_path, 编码次数)
+    """
+    with Image.open(pic) as img:
         exif = img.getexif()
         img = resize_image(img, gallery)
-        pic_path = pic.with_suffix(gallery.thumb_suffix())
-        img.save(pic_path, gallery.image_output_format, exif=reset_exif(exif))
-        print(f"Resize to {pic_path}")
+    if gallery.image_output_format == ImageFormat.JPEG.name \
+            and img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    exif = reset_exif(exif).tobytes()
+    data, passes = encode_within_size(
+        img, gallery.image_output_format, exif, gallery.image_size_max * MB)
+    pic_path = pic.with_suffix(gallery.thumb_suffix())
+    pic_path.write_bytes(data)
+    return pic_path, passes
+
+
+Quality_Max = 90
+Quality_Min = 30
+"""encode_within_size 的画质搜索范围"""
+
+Size_Tolerance = 0.9
+"""编码后的体积达到上限的 90% 即可停止搜索"""
+
+
+def encode_image(img:Image, img_format:str, exif:bytes, quality:int) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, img_format, exif=exif, quality=quality,
+             optimize=True, progressive=True)
+    return buf.getvalue()
+
+
+def encode_within_size(
+        img:Image, img_format:str, exif:bytes, size_max:int
+) -> tuple[bytes, int]:
+    """在体积不超过 size_max 的前提下, 采用尽可能高的画质编码图片.
+
+    先采用最高画质, 超过上限时根据已知的 (画质, 体积) 插值估算下一个画质,
+    体积落在 [size_max * Size_Tolerance, size_max] 之间即停止,
+    通常只需编码三四次. 即使采用最低画质仍超过上限, 则进一步缩小尺寸.
+
+    :return: (编码后的图片, 编码次数)
+    """
+    passes = 1
+    data = encode_image(img, img_format, exif, Quality_Max)
+    if len(data) <= size_max:
+        return data, passes
+
+    best = None
+    low = None  # (quality, size), 体积不超过上限
+    high = (Quality_Max, len(data))  # (quality, size), 体积超过上限
+    quality = round(Quality_Max * size_max / len(data))
+    while True:
+        quality = min(max(quality, Quality_Min), high[0] - 1)
+        if low is not None:
+            quality = max(quality, low[0] + 1)
+        if quality >= high[0]:
+            break
+        data = encode_image(img, img_format, exif, quality)
+        passes += 1
+        if len(data) <= size_max:
+            best, low = data, (quality, len(data))
+            if len(data) >= size_max * Size_Tolerance:
+                break
+        else:
+            high = (quality, len(data))
+            if quality <= Quality_Min:
+                break
+        if low is None:
+            quality = round(quality * size_max / len(data))
+        else:
+            (q1, s1), (q2, s2) = low, high
+            quality = q1 + round((size_max - s1) * (q2 - q1) / (s2 - s1))
+
+    if best is not None:
+        return best, passes
+
+    # 最低画质仍超过上限, 按体积比例缩小尺寸后重试.
+    ratio = math.sqrt(size_max / len(data)) * 0.9
+    size = max(1, round(img.width * ratio)), max(1, round(img.height * ratio))
+    data, more_passes = encode_within_size(
+        img.resize(size), img_format, exif, size_max)
+    return data, passes + more_passes
 
 
 def reset_exif(exif):
@@ -441,26 +990,90 @@ def print_oversize_pics(oversize_pics):
             print(pic)
 
 
-def get_oversize_pics(pics:list[Path], gallery:Gallery) -> list:
-    oversize_pics = []
-    for pic in pics:
-        img = open_image(pic)
-        if img is None:
-            continue
-        if is_image_oversize(img, pic, gallery):
-            oversize_pics.append(pic)
-    return oversize_pics
+def get_oversize_pics(infos:dict[Path, ImageInfo|None], gallery:Gallery) -> list:
+    return [pic for pic, info in infos.items()
+            if info is not None and is_image_oversize(info, gallery)]
+
+
+def probe_images(
+        pics:dict[Path, FileStat], records:dict[str, dict], executor=None, jobs:int=1
+) -> dict[Path, ImageInfo|None]:
+    """读取一个相册内全部图片的文件头, 不是图片的文件对应 None.
+
+    pics 来自 get_pic_files (相册快照).
+    records 来自 db.get_album_images, 体积与修改时间都与记录一致的图片直接采用记录,
+    其余图片读取后更新到 db.images 及 records 中. 并且会删除已不存在的图片的记录.
+    """
+    infos = {}
+    to_probe = []
+    for pic, stat in pics.items():
+        record = records.get(pic.name)
+        if record and record["filesize"] == stat.size \
+                and record["mtime_ns"] == stat.mtime_ns:
+            infos[pic] = db.record_to_info(record)
+        else:
+            to_probe.append(pic)
+
+    stats = [pics[pic] for pic in to_probe]
+    for pic, info in zip(to_probe, pool_map(executor, jobs, probe_image, to_probe, stats)):
+        album = pic.parent.name
+        records[pic.name] = db.save_image(album, pic.name, info)
+        infos[pic] = info
+
+    names = set(pic.name for pic in pics)
+    stale = [name for name in records if name not in names]
+    if stale:
+        db.delete_images(records[stale[0]]["album"], stale)
+
+    return {pic: (info if info.is_image() else None) for pic, info in infos.items()}
+
 
+def probe_image(file:Path, stat:FileStat) -> ImageInfo:
+    """只读取图片的文件头 (不解码像素), 获取尺寸, 格式, 方向及拍摄日期,
+    另外计算文件内容的 checksum. 体积及修改时间来自相册快照.
 
-def get_image_datetime(img:Image):
-    exif = img.getexif()
+    不是图片时, 返回的 ImageInfo.format 是空字符串.
+    """
+    info = ImageInfo(
+        filesize=stat.size,
+        mtime_ns=stat.mtime_ns,
+        checksum=file_checksum(file),
+        width=0,
+        height=0,
+        format="",
+        orientation=1,
+        datetime="",
+    )
+    try:
+        with Image.open(file) as img:
+            info.width, info.height = img.size
+            exif = img.getexif()
+            info.format = img.format
+    except OSError:
+        return info
+    info.orientation = exif.get(Orientation, 1)
+    info.datetime = get_exif_datetime(exif)
+    return info
+
+
+def file_checksum(file:Path) -> str:
+    """sha1, 分块读取, 避免一次性读入大文件."""
+    sha1 = hashlib.sha1()
+    with open(file, "rb") as f:
+        while chunk := f.read(MB):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_exif_datetime(exif) -> str:
+    """:return: 拍摄日期 (RFC3339), 没有则返回空字符串."""
     if DateTimeOriginal in exif:
         dt = arrow.get(exif[DateTimeOriginal], ImageDateTimeFormat)
         return dt.to("local").format(model.RFC3339)
     if DateTime in exif:
         dt = arrow.get(exif[DateTime], ImageDateTimeFormat)
         return dt.to("local").format(model.RFC3339)
-    return model.now()
+    return ""
 
 
 def get_pic_toml_path(pic_path:Path) -> Path:
@@ -468,31 +1081,156 @@ def get_pic_toml_path(pic_path:Path) -> Path:
     return pic_path.parent.joinpath(Metadata, pic_toml_name)
 
 
-def create_pic_toml_if_not_exists(img:Image, pic_path:Path):
-    """
-    :return: True 表示这是新图片, 否则返回 False
-    """
+def create_pic_toml(pic_path:Path, ctime:str):
     pic_toml_path = get_pic_toml_path(pic_path)
-    if not pic_toml_path.exists():
-        pic = Picture.default(pic_path, get_image_datetime(img))
-        render_picture_toml(pic_toml_path, pic)
-        return True
-    return False
+    pic = Picture.default(pic_path, ctime)
+    render_picture_toml(pic_toml_path, pic)
 
 
-def create_thumb_if_not_exists(
-        img:Image, pic_path:Path, album_path:Path, gallery:Gallery) -> Path:
+def get_thumb_path(pic_path:Path, album_path:Path, gallery:Gallery) -> Path:
     thumb_name = pic_path.with_suffix(gallery.thumb_suffix()).name.lower()
-    thumb_path = album_path.joinpath(Thumbs, thumb_name)
-    create_thumb(img, thumb_path, gallery)
+    return album_path.joinpath(Thumbs, thumb_name)
+
+
+def create_thumb_if_not_exists(
+        pic_path:Path, info:ImageInfo, album_path:Path, gallery:Gallery) -> Path:
+    thumb_path = get_thumb_path(pic_path, album_path, gallery)
+    create_thumb(pic_path, info, thumb_path, gallery)
     return thumb_path
 
 
-def create_thumb(img:Image, thumb_path:Path, gallery:Gallery):
-    img = ImageOps.exif_transpose(img)
-    img = ImageOps.fit(img, gallery.thumbnail_size())
+def create_thumb(pic_path:Path, info:ImageInfo, thumb_path:Path, gallery:Gallery):
+    """先缩小再摆正, 最后才裁剪成正方形, 避免完整解码大尺寸图片.
+
+    JPEG 采用 draft 模式, 在解码时直接缩小 (1/2, 1/4 或 1/8),
+    其他格式则在解码后先用 reduce 粗略缩小.
+    """
+    with Image.open(pic_path) as img:
+        img = reduce_image(img, gallery.thumb_size * Thumb_Draft_Scale)
+        img = transpose_image(img, info.orientation)
+        img = to_output_mode(img)
+        img = ImageOps.fit(img, gallery.thumbnail_size())
     img.save(thumb_path, gallery.image_output_format)
-    print(f"Create thumbnail {thumb_path}")
+
+
+def to_output_mode(img:Image):
+    """JPEG 只能保存 RGB, L 等 mode, 其他 mode (例如 1, P, RGBA, I;16) 先转换为 RGB."""
+    if img.mode not in ("RGB", "L"):
+        return img.convert("RGB")
+    return img
+
+
+Thumb_Draft_Scale = 2
+"""粗略缩小时保留缩略图边长的 2 倍, 以便最后一步缩小时保持画质"""
+
+
+Reduce_Modes = ("L", "LA", "RGB", "RGBA", "I", "F", "CMYK")
+"""Image.reduce 支持的 mode, 其他 mode (例如 1, P, I;16) 会出错."""
+
+
+def reduce_image(img:Image, min_side:int):
+    """把图片粗略缩小, 但保证宽和高都不小于 min_side.
+    Image.reduce 不支持的 mode 则跳过这一步 (由之后的 ImageOps.fit 缩小).
+    """
+    img.draft(img.mode, (min_side, min_side))
+    factor = min(img.size) // min_side
+    if factor >= 2 and img.mode in Reduce_Modes:
+        img = img.reduce(factor)
+    return img
+
+
+def create_derivatives(
+        pic_path:Path,
+        info:ImageInfo,
+        old_paths:list[Path],
+        album_path:Path,
+        gallery:Gallery
+) -> list[Path]:
+    """生成图片的缩小版本 (用于 srcset).
+
+    只解码一次, 并且在解码时直接缩小到不小于最大的宽度 (draft 模式).
+    该图片原有的缩小版本 (old_paths) 会先被删除.
+    :return: 全部缩小版本
+    """
+    derivs_path = album_path.joinpath(Derivs)
+    file_id = pic_path.stem.lower()
+    for old_path in old_paths:
+        old_path.unlink(missing_ok=True)
+
+    widths = gallery.deriv_widths(info)
+    if not widths:
+        return []
+    derivs_path.mkdir(exist_ok=True)
+
+    with Image.open(pic_path) as img:
+        ratio = widths[0] / info.display_width()
+        img.draft(img.mode, (math.ceil(img.width*ratio), math.ceil(img.height*ratio)))
+        img = transpose_image(img, info.orientation)
+        img.load()
+    img = to_output_mode(img)
+
+    deriv_paths = []
+    for width in widths:
+        height = max(1, round(img.height * width / img.width))
+        resized = img.resize((width, height), Image.Resampling.LANCZOS)
+        for suffix, img_format in gallery.deriv_formats():
+            deriv_path = derivs_path.joinpath(f"{file_id}-{width}{suffix}")
+            resized.save(deriv_path, img_format)
+            deriv_paths.append(deriv_path)
+    return deriv_paths
+
+
+Deriv_Name_Pattern = re.compile(r"(.+)-\d+\.[a-z]+")
+"""缩小版本的文件名格式: {file_id}-{宽度}{后缀名}"""
+
+
+def get_album_derivs(derivs_path:Path) -> dict[str, list[Path]]:
+    """一个相册的全部缩小版本, 按图片分组 (每个相册只读取一次 derivs 文件夹).
+
+    :return: dict(file_id: 该图片的缩小版本)
+    """
+    album_derivs = {}
+    if not derivs_path.exists():
+        return album_derivs
+    for path in derivs_path.iterdir():
+        if match := Deriv_Name_Pattern.fullmatch(path.name):
+            album_derivs.setdefault(match.group(1), []).append(path)
+    return album_derivs
+
+
+def get_deriv_data(record:dict|None, gallery:Gallery) -> dict:
+    """根据 db.images 的记录, 得到 PictureData 中与缩小版本有关的项目."""
+    if not record or not record["format"]:
+        return {}
+    info = db.record_to_info(record)
+    if record["derivs"] != gallery.deriv_signature(info):
+        return dict(width=info.display_width())
+    return dict(
+        width=info.display_width(),
+        deriv_widths=gallery.deriv_widths(info),
+        deriv_webp=gallery.derivative_webp,
+        deriv_suffix=gallery.thumb_suffix(),
+    )
+
+
+# EXIF Orientation 与 PIL 变换方法的对应关系, 参考 ImageOps.exif_transpose
+Orientation_Transpose = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def transpose_image(img:Image, orientation:int):
+    """根据 ImageInfo.orientation 摆正图片 (不需要再次读取 EXIF)"""
+    method = Orientation_Transpose.get(orientation)
+    if method is None:
+        return img
+    return img.transpose(method)
 
 
 def resize_image(img:Image, gallery:Gallery):
@@ -519,153 +1257,183 @@ def resize_image(img:Image, gallery:Gallery):
     return img
 
 
-def is_image_oversize(img:Image, file:Path, gallery:Gallery):
-    filesize = file.lstat().st_size
-    width, height = img.size
-    if width > gallery.image_width_max \
-            or height > gallery.image_height_max \
-            or filesize > gallery.image_size_max * MB:
+def is_image_oversize(info:ImageInfo, gallery:Gallery):
+    if info.width > gallery.image_width_max \
+            or info.height > gallery.image_height_max \
+            or info.filesize > gallery.image_size_max * MB:
         return True
     return False
 
 
-def open_image(file):
-    """
-    :return: Image | None
-    """
-    try:
-        img = Image.open(file)
-    except OSError:
-        img = None
-    return img
-
-
 def render_index_html(
         output_type:str,
         tmpl_name:str,
         output_path:Path,
-        gallery:Gallery,
+        data:dict,
         force=False
-) -> bool:
-    """返回 True 表示执行了渲染。"""
-    checksum = gallery.make_checksum()
-    if gallery.checksum != checksum:
-        gallery.checksum = checksum
-        render_gallery_toml(gallery)
-        force = True
-
-    if force:
-        render_write(tmpl_name, output_path, dict(
-            output_type=output_type,
-            gallery=gallery.to_data(),
-            albums=gallery.get_albumdata(),
-        ))
-
-    return force
+):
+    """data 包括 gallery:GalleryData 及 albums:list[AlbumData]"""
+    render_output(
+        tmpl_name, output_path, dict(output_type=output_type, **data), force)
 
 
 def render_album_index_html(
-        local_output_folder:Path,
-        web_output_folder:Path,
-        r2_output_folder:Path,
-        gallery:Gallery,
+        album_folders:dict[str, Path],
+        gallery:GalleryData,
         album:Album,
         album_data:AlbumData,
         pics_data_list:list[PictureData],
         force=False
-) -> bool:
-    """:return: True 表示需要重新渲染 gallery 首页."""
-    update_gallery = False
+):
     checksum = album.make_checksum()
     if album.checksum != checksum:
         album.checksum = checksum
         render_album_toml(album, album_data.name)
-        force = True
-        update_gallery = True
-
-    if force:
-        local_output_path    = local_output_folder.joinpath(Index_HTML)
-        local_output_path2   = local_output_folder.joinpath(Index2_HTML)
-        web_output_path      = web_output_folder.joinpath(Index_HTML)
-        web_output_path2     = web_output_folder.joinpath(Index2_HTML)
-        r2_output_path       = r2_output_folder.joinpath(Index_HTML)
-        r2_output_path2      = r2_output_folder.joinpath(Index2_HTML)
-        local_js_output_path = local_output_folder.joinpath(Pics_Id_List_JS)
-        web_js_output_path   = web_output_folder.joinpath(Pics_Id_List_JS)
-        r2_js_output_path    = r2_output_folder.joinpath(Pics_Id_List_JS)
-        gallery_data         = gallery.to_data()
-
-        data = dict(gallery=gallery_data, album=album_data, pictures=pics_data_list,)
-        render_write(album.index_html_name(), r2_output_path, data)
-        render_write(Album_Index_List_HTML, r2_output_path2, data)
-
-        data["parent_dir"]=f"../../{album_data.name}/"
-        render_write(album.index_html_name(), local_output_path, data)
-        render_write(Album_Index_List_HTML, local_output_path2, data)
-
-        data["parent_dir"]=f"{gallery.bucket_url}{album_data.name}/"
-        render_write(album.index_html_name(), web_output_path, data)
-        render_write(Album_Index_List_HTML, web_output_path2, data)
-
-        pics_id_list = [pic.file_id for pic in pics_data_list]
-        pics_id_data = dict(pics=pics_id_list)
-        render_write(Pics_Id_List_JS, local_js_output_path, pics_id_data)
-        render_write(Pics_Id_List_JS, web_js_output_path, pics_id_data)
-        render_write(Pics_Id_List_JS, r2_js_output_path, pics_id_data)
-
-    return update_gallery
+
+    pages = paginate(pics_data_list, album.page_size)
+    # Single 只展示一张图片, 不需要分页
+    index_total = 1 if album.frontpage == Frontpage.Single.name else len(pages)
+    page_names = []
+    for tmpl_name, filename, total in [
+        (album.index_html_name(), Index_HTML, index_total),
+        (Album_Index_List_HTML, Index2_HTML, len(pages)),
+    ]:
+        for num in range(1, total+1):
+            page_name = get_page_name(filename, num)
+            data = dict(gallery=gallery, album=album_data, pictures=pages[num-1],
+                        page=get_page_data(filename, num, total))
+            outputs = get_variant_outputs(
+                album_folders, page_name, album_data.name, gallery.bucket_url)
+            render_variants(tmpl_name, outputs, data, force)
+            page_names.append(page_name)
+        delete_stale_pages(album_folders, filename, total)
+
+    pics_id_list = [pic.file_id for pic in pics_data_list]
+    pics_id_data = dict(pics=pics_id_list)
+    for folder in album_folders.values():
+        render_output(
+            Pics_Id_List_JS, folder.joinpath(Pics_Id_List_JS), pics_id_data, force)
+    return page_names
+
+
+def paginate(items:list, page_size:int) -> list[list]:
+    """page_size 小于等于零时不分页. 没有 items 时也有一页 (空页)."""
+    if page_size <= 0 or not items:
+        return [items]
+    return [items[i:i+page_size] for i in range(0, len(items), page_size)]
+
+
+def get_page_name(filename:str, num:int) -> str:
+    """第一页是 filename 本身 (例如 index.html), 第二页起是 index-2.html, index-3.html ..."""
+    if num == 1:
+        return filename
+    name = Path(filename)
+    return f"{name.stem}-{num}{name.suffix}"
+
+
+def get_page_data(filename:str, num:int, total:int) -> PageData:
+    return PageData(
+        num=num,
+        total=total,
+        prev=get_page_name(filename, num-1) if num > 1 else "",
+        next=get_page_name(filename, num+1) if num < total else "",
+    )
+
+
+def delete_stale_pages(folders:dict[str, Path], filename:str, total:int):
+    """图片或相册减少 (或每页数量变大) 后, 删除多余的分页, 并从 r2_files 中删除,
+    已上传的分页则记录到 r2_deleting, 等执行 `r2g upload` 时从云端删除.
+
+    folders: dict(输出目标: 分页所在的文件夹)
+    """
+    name = Path(filename)
+    pattern = re.compile(rf"{name.stem}-(\d+){re.escape(name.suffix)}")
+    stale_obj_names = []
+    for target, folder in folders.items():
+        for file in folder.glob(f"{name.stem}-*{name.suffix}"):
+            match = pattern.fullmatch(file.name)
+            if match and int(match.group(1)) > total:
+                print(f"delete {file}")
+                file.unlink()
+                if target == "r2":
+                    stale_obj_names.append(
+                        file.relative_to(Output_R2_Path).as_posix())
+    if stale_obj_names:
+        r2_files = r2.get_r2_files()
+        # checksum 为空表示尚未上传
+        uploaded = [name for name in stale_obj_names if r2_files.pop(name, None)]
+        r2.write_r2_files_json(r2_files)
+        if uploaded:
+            r2.add_to_r2_deleting(uploaded)
+
+
+def get_variant_outputs(
+        album_folders:dict[str, Path],
+        filename:str,
+        album_name:str,
+        bucket_url:str
+) -> dict[Path, str]:
+    """:return: dict(各个输出目标中的 filename: parent_dir), 用于 render_variants"""
+    return {
+        folder.joinpath(filename): get_parent_dir(target, album_name, bucket_url)
+        for target, folder in album_folders.items()
+    }
 
 
 def render_album_pics(
         pics_paths:list[Path],
-        local_album_folder:Path,
-        web_album_folder:Path,
-        r2_album_folder:Path,
+        album_folders:dict[str, Path],
         album:AlbumData,
         gallery:GalleryData,
+        derivs:dict[Path, dict],
+        executor:ThreadPoolExecutor,
         force=False
-) -> list[PictureData]:
-    """返回 PictureData 有用."""
-    pic_data_list = []
-    for pic_path in pics_paths:
-        pic_data = render_pic_html(
-            pic_path, local_album_folder, web_album_folder, r2_album_folder,
-            album, gallery, force)
-        pic_data_list.append(pic_data)
-    return pic_data_list
+) -> list[Future]:
+    """把相册内每张图片的网页提交到 executor 中渲染.
+
+    返回 Future 的列表 (顺序与 pics_paths 一致), 其结果是 PictureData.
+    derivs 的值来自 get_deriv_data.
+    每张图片的上一张/下一张 (首尾相连) 在这里确定, 直接写进网页.
+    """
+    pics_id_list = [pic_path.stem.lower() for pic_path in pics_paths]
+    return [
+        executor.submit(
+            render_pic_html,
+            pic_path, album_folders, album, gallery, derivs.get(pic_path),
+            (pics_id_list[i-1], pics_id_list[(i+1) % len(pics_id_list)]),
+            force)
+        for i, pic_path in enumerate(pics_paths)
+    ]
 
 
 def render_pic_html(
         pic_path:Path,
-        local_album_folder:Path,
-        web_album_folder:Path,
-        r2_album_folder:Path,
+        album_folders:dict[str, Path],
         album:AlbumData,
         gallery:GalleryData,
+        deriv_data:dict=None,
+        neighbors:tuple[str, str]=("", ""),
         force=False
 ) -> PictureData:
-    """返回 PictureData 有用."""
+    """返回 PictureData 有用.
+
+    neighbors 是 (上一张, 下一张) 图片的 file_id.
+    """
     pic_toml_path = get_pic_toml_path(pic_path)
     pic = Picture.loads(pic_toml_path)
-    pic_data = pic.to_data(pic_path)
+    pic_data = pic.to_data(pic_path, deriv_data)
     checksum = pic.make_checksum()
     if pic.checksum != checksum:
         pic.checksum = checksum
         render_picture_toml(pic_toml_path, pic)
-        force = True
-
-    if force:
-        pic_html_name = f"{pic_data.file_id}{Dot_HTML}"
-        local_output_path = local_album_folder.joinpath(pic_html_name)
-        web_output_path = web_album_folder.joinpath(pic_html_name)
-        r2_output_path = r2_album_folder.joinpath(pic_html_name)
 
-        data = dict(pic=pic_data, album=album, gallery=gallery)
-        render_write(Pic_HTML, r2_output_path, data)
-        data["parent_dir"] = f"../../{album.name}/"
-        render_write(Pic_HTML, local_output_path, data)
-        data["parent_dir"] = f"{gallery.bucket_url}{album.name}/"
-        render_write(Pic_HTML, web_output_path, data)
+    pic_html_name = f"{pic_data.file_id}{Dot_HTML}"
+    outputs = get_variant_outputs(
+        album_folders, pic_html_name, album.name, gallery.bucket_url)
+    prev_pic, next_pic = neighbors
+    data = dict(pic=pic_data, album=album, gallery=gallery,
+                prev_pic=prev_pic, next_pic=next_pic)
+    render_variants(Pic_HTML, outputs, data, force)
 
     return pic_data
 
@@ -682,7 +1450,7 @@ def delete_pic_or_album(filepath:Path, gallery:Gallery, bucket):
         album_toml_path = filepath.parent.joinpath(Album_Toml)
         album = Album.loads(album_toml_path)
         album.delete_pic(filepath.name)
-        render_album_toml(album, filepath.name)
+        render_album_toml(album, filepath.parent.name)
     else:
         if not is_album_in_gallery(filepath):
             print(f"不在图库内: {filepath}")
@@ -695,6 +1463,7 @@ def delete_pic_or_album(filepath:Path, gallery:Gallery, bucket):
 
 def delete_album(album_path:Path, gallery:Gallery, bucket):
     r2.delete_album(album_path.name, bucket)
+    db.delete_album_images(album_path.name)
     output_local_path = Output_Local_Path.joinpath(album_path.name)
     output_web_path = Output_Web_Path.joinpath(album_path.name)
     output_r2_path = Output_R2_Path.joinpath(album_path.name)
@@ -714,6 +1483,7 @@ def delete_pic(pic_path:Path, thumb_path:Path, toml_path:Path, bucket):
     album_folder = parts[-2]
     pic_obj_name = "/".join(parts[-2:])
     thumb_obj_name = "/".join(thumb_path.parts[-3:])
+    deriv_paths = get_album_derivs(pic_path.parent.joinpath(Derivs)).get(pic_id, [])
     html_obj_name = f"{album_folder}/{pic_id + Dot_HTML}"
     local_html_path = Output_Local_Path.joinpath(html_obj_name)
     web_html_path = Output_Web_Path.joinpath(html_obj_name)
@@ -724,6 +1494,9 @@ def delete_pic(pic_path:Path, thumb_path:Path, toml_path:Path, bucket):
         objects_to_delete.add(pic_obj_name)
     if str(thumb_path) not in r2_waiting:
         objects_to_delete.add(thumb_obj_name)
+    for deriv_path in deriv_paths:
+        if str(deriv_path) not in r2_waiting:
+            objects_to_delete.add("/".join(deriv_path.parts[-3:]))
     if r2_files.get(html_obj_name, ""):
         objects_to_delete.add(html_obj_name)
         r2.delete_from_r2_files(html_obj_name, r2_files)
@@ -731,7 +1504,8 @@ def delete_pic(pic_path:Path, thumb_path:Path, toml_path:Path, bucket):
     r2.delete_objects(objects_to_delete, bucket)
 
     paths_to_delete = [pic_path, thumb_path, toml_path, local_html_path,
-                       web_html_path, r2_html_path]
+                       web_html_path, r2_html_path, *deriv_paths]
+    model.toml_map.forget(toml_path)
     for file in paths_to_delete:
         if file.exists():
             print(f"Delete {file}")
@@ -751,7 +1525,7 @@ def check_pic_in_album(filepath:Path) -> str:
 def check_album_in_gallery(album_path:Path) -> str:
     if not is_album_in_gallery(album_path):
         return f"不在当前图库内: {album_path}"
-    if album_path.name in [Output_Local, Output_Web, Output_R2, Templates]:
+    if album_path.name in Not_Album_Folders:
         return f"不是相册: {album_path}"
     return ""
 
@@ -0,0 +1,200 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+from . import model, util
+from .const import CWD, Gallery_Toml_Path, Templates_Path, Metadata, Dot_Toml
+from .model import Gallery, FileStat
+
+"""
+r2g watch: 监视图库, 有变化时只更新受影响的相册.
+
+Linux 采用 inotify (通过 ctypes 调用 libc, 不需要安装第三方库),
+其他系统或 inotify 不可用时, 每隔一段时间扫描一次文件夹 (轮询).
+
+监视的范围: gallery.toml, templates 文件夹, 每个相册的文件夹及其 metadata 文件夹.
+不监视 thumbs, derivs 及 output_* 文件夹, 因此本程序写入的缩略图及网页不会引起重建.
+本程序写入的 toml 会引起一次重建, 但这次重建没有任何变化, 不会再写入文件.
+"""
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_DELETE      = 0x00000200
+IN_CLOEXEC     = 0o2000000
+
+Inotify_Mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+Inotify_Event = struct.Struct("iIII")  # wd, mask, cookie, len (之后是 name)
+
+Quiet_Period = 0.3
+"""收到变化后, 等待这么多秒内没有新的变化, 才开始重建 (例如一次复制多张图片)."""
+
+
+class InotifyWatcher:
+    """Linux inotify, 只监视文件夹本身 (不含子文件夹)."""
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}  # wd -> folder
+
+    def watch(self, folders:list[Path]):
+        """增加监视的文件夹 (已在监视中的文件夹不会重复添加)."""
+        for folder in folders:
+            if folder in self.folders.values():
+                continue
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(folder), Inotify_Mask)
+            if wd < 0:
+                print(f"无法监视 {folder}", file=sys.stderr)
+                continue
+            self.folders[wd] = folder
+
+    def wait(self) -> set[Path]:
+        """阻塞, 直至有变化, 并且 Quiet_Period 秒内没有新的变化.
+
+        :return: 有变化的文件
+        """
+        changed = self.read_events()
+        while select.select([self.fd], [], [], Quiet_Period)[0]:
+            changed |= self.read_events()
+        return changed
+
+    def read_events(self) -> set[Path]:
+        data = os.read(self.fd, 64 * 1024)
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            wd, _, _, name_len = Inotify_Event.unpack_from(data, pos)
+            pos += Inotify_Event.size
+            name = data[pos:pos+name_len].rstrip(b"\0")
+            pos += name_len
+            if wd in self.folders and name:
+                changed.add(self.folders[wd].joinpath(os.fsdecode(name)))
+        return changed
+
+
+class PollWatcher:
+    """每隔 interval 秒扫描一次全部文件夹, 比较文件的体积及修改时间."""
+    def __init__(self, interval:float):
+        self.interval = interval
+        self.folders = []
+        self.files = {}
+
+    def watch(self, folders:list[Path]):
+        self.folders = folders
+        self.files = self.scan()
+
+    def scan(self) -> dict[Path, FileStat]:
+        files = {}
+        for folder in self.folders:
+            if folder.exists():
+                files.update(util.scan_files(folder))
+        return files
+
+    def wait(self) -> set[Path]:
+        """阻塞, 直至有变化, 并且 interval 秒内没有新的变化.
+
+        :return: 有变化的文件
+        """
+        changed = set()
+        while True:
+            time.sleep(self.interval)
+            files = self.scan()
+            new_changes = {file for file in files.keys() | self.files.keys()
+                           if files.get(file) != self.files.get(file)}
+            self.files = files
+            if new_changes:
+                changed |= new_changes
+            elif changed:
+                return changed
+
+
+def get_watcher(poll:bool, interval:float):
+    """Linux 默认采用 inotify, 不可用时采用轮询."""
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as err:
+            print(f"inotify 不可用 ({err}), 改为轮询.")
+    return PollWatcher(interval)
+
+
+def get_watch_folders(gallery:Gallery) -> list[Path]:
+    folders = [CWD, Templates_Path]
+    for album_path in util.get_all_albums(gallery):
+        folders.extend([album_path, album_path.joinpath(Metadata)])
+    return folders
+
+
+def watch_gallery(gallery:Gallery, watcher, jobs:int, targets:list[str]):
+    """先完整更新一次 (相当于 r2g -update), 之后只重建有变化的相册."""
+    rebuild(gallery, util.get_all_albums(gallery), jobs, targets)
+    watcher.watch(get_watch_folders(gallery))
+    print(f"正在监视图库 {CWD} (按 Ctrl+C 结束)")
+    while True:
+        changed = watcher.wait()
+        for file in changed:
+            if file.suffix == Dot_Toml:
+                model.toml_map.forget(file)
+
+        rebuild_all = False
+        if Gallery_Toml_Path in changed:
+            try:
+                gallery = Gallery.loads()
+            except Exception as err:
+                print(f"Error: {Gallery_Toml_Path}: {err}", file=sys.stderr)
+                continue
+            watcher.watch(get_watch_folders(gallery))
+            rebuild_all = True
+        if any(file.parent == Templates_Path for file in changed):
+            util.clear_template_checksums()
+            rebuild_all = True
+
+        if rebuild_all:
+            albums = util.get_all_albums(gallery)
+        else:
+            names = {get_album_name(file) for file in changed}
+            albums = [CWD.joinpath(name) for name in gallery.albums if name in names]
+        if albums:
+            start = time.perf_counter()
+            if rebuild(gallery, albums, jobs, targets):
+                print(f"更新了 {len(albums)} 个相册 ({time.perf_counter()-start:.2f}s)")
+
+
+def get_album_name(file:Path) -> str:
+    """:return: file 所在的相册名, 不在相册内则返回空字符串."""
+    parts = file.relative_to(CWD).parts
+    return parts[0] if len(parts) > 1 else ""
+
+
+def rebuild(gallery:Gallery, albums:list[Path], jobs:int, targets:list[str]) -> bool:
+    """与 r2g -update 的步骤相同, 但只处理 albums 里的相册.
+    图库首页总是重新生成 (没有变化的首页会被跳过).
+
+    :return: 成功返回 True, 有错 (已打印错误信息) 返回 False
+    """
+    try:
+        albums_pics = {str(album): util.get_pic_files(album) for album in albums}
+        if util.check_all_bad_names(albums_pics) > 0:
+            return False
+        if util.check_all_double_names(albums_pics) > 0:
+            return False
+        if util.update_all_albums(albums_pics, gallery, jobs):
+            return False
+        if err := util.check_all_albums_cover(albums_pics):
+            print(f"Error: {err}", file=sys.stderr)
+            return False
+        util.render_all(albums_pics, gallery, jobs=jobs, targets=targets)
+    except Exception as err:
+        # 编辑中的 toml 可能暂时有格式错误, 不应结束监视
+        print(f"Error: {err}", file=sys.stderr)
+        return False
+    return True